@@ -9,10 +9,10 @@ table containing production per hour. The resulting table contains,
 per hour:
     part number, lot, pieces made, n pieces rejected per defect, total downtime,
     planned downtime and unplanned downtime.
-Calculating OEE per hour is then straightforward:
+Calculating OEE per hour is then straightforward (see add_oee):
     availability = (available time) / (planned time) = 
         (time - unplanned - planned) / (time - planned)
-    performance = (target production) / (available time)
+    performance = (n total parts produced) / (target production in the available time)
     quality = (n good parts produced) / (n total parts produced)
 '''
 
@@ -20,7 +20,32 @@ import numpy as np #main libraries
 import pandas as pd #main libraries
 import datetime
 import os
+import io
+import json
 import fnmatch #search for files using RE
+import concurrent.futures #runs robots in parallel
+import hashlib #names the parse cache entries
+import heapq #sweep-line merge of overlapping stoppages
+import contextlib #instrumentation of the stages
+import time
+import sqlite3 #hourly store
+import threading #watch mode
+import urllib.parse
+import wsgiref.simple_server #JSON endpoint of the watch mode
+import cProfile
+import tracemalloc
+try: # optional: the parse cache is stored in Feather (columnar) format when pyarrow is installed
+    import pyarrow
+except ImportError:
+    pyarrow = None
+try: # peak RSS of the process (not available on Windows)
+    import resource
+except ImportError:
+    resource = None
+try: # optional: RSS of the stages, also on Windows, when psutil is installed
+    import psutil
+except ImportError:
+    psutil = None
 
 
 def find(pattern, path):
@@ -38,39 +63,48 @@ def find(pattern, path):
     return result
 
 
+def get_metric_folder(robot_folder_name='Rb-17', metric_folder='RobotFailure'):
+    '''
+    Returns the folder of a metric on the robot's share (see get_input_file_name).
+    Arguments: robot_folder_name, metric_folder.
+    Returns: folder path.
+    '''
+    windows_separator_for_network_access = '\\' # needs \\ to open files on Windows. TODO be updated to be more generic
+    return os.sep.join([str(windows_separator_for_network_access), 
+                        str(robot_folder_name), 'LocalShare', 'RuntimeData',
+                        str(metric_folder) + 'Logs']) #folder ends with 'Logs' and files end with 'Log'
+
+
 def get_input_file_name(robot_folder_name='Rb-17', file_name_prefix='RB17', metric_folder='RobotFailureLogs',
-                    day_folder=str(datetime.datetime.now().strftime('%B')),
-                    month_folder=str(datetime.datetime.now().strftime('%B')),
+                    day_folder=None, month_folder=None,
                     year_folder=2022):#datetime.datetime.now().strftime('%Y')):
     '''
     Returns the path for the file to be oppened.
     This function uses the robots folders hierarchies to translate the inputs into a file path.
-    If no specific DateTime is provided, it uses the system current DateTime. 
+    If no specific DateTime is provided, it uses the system current DateTime (when called, not when imported).
     Arguments: robot_folder_name, file_name_prefix, metric_folder, day_folder, month_folder, year_folder.
     Returns: file path.
     '''
-    windows_separator_for_network_access = '\\' # needs \\ to open files on Windows. TODO be updated to be more generic
+    if day_folder is None:
+        day_folder = str(datetime.datetime.now().strftime('%B'))
+    if month_folder is None:
+        month_folder = str(datetime.datetime.now().strftime('%B'))
+    metric_folder_path = get_metric_folder(robot_folder_name, metric_folder)
     # metrics have different folders structures, stored in the _directories_ dictionary. Retrieve them for path retrieval
-    if directories[metric_folder] == 'YMF_D': 
-        file_path = os.sep.join([str(windows_separator_for_network_access), 
-                        str(robot_folder_name), 'LocalShare', 'RuntimeData',
-                        str(metric_folder) + 'Logs', #folder ends with 'Logs' and files end with 'Log'
+    if directories[metric_folder]['layout'] == 'YMF_D': 
+        file_path = os.sep.join([metric_folder_path,
                         str(year_folder), str(month_folder), str(file_name_prefix) + 
                         '_' + str(metric_folder) + 'Log_' + datetime.datetime.now().strftime('%d') + '.csv'])
 
-    elif directories[metric_folder] == 'F_Y': #RobotFailureLogs
-        file_path = os.sep.join([str(windows_separator_for_network_access), 
-                        str(robot_folder_name), 'LocalShare', 'RuntimeData',
-                        str(metric_folder) + 'Logs', #folder ends with 'Logs' and files end with 'Log'
+    elif directories[metric_folder]['layout'] == 'F_Y': #RobotFailureLogs
+        file_path = os.sep.join([metric_folder_path,
                         #year_folder, 
                         #month_folder,
                         str(file_name_prefix) + '_' + str(metric_folder) + 'Log_' +
                         str(year_folder) + '.csv'])
 
-    elif directories[metric_folder] == 'YF_M': #RobotStoppageLogs
-        file_path = os.sep.join([str(windows_separator_for_network_access), 
-                        str(robot_folder_name), 'LocalShare', 'RuntimeData',
-                        str(metric_folder) + 'Logs', #folder ends with 'Logs' and files end with 'Log'
+    elif directories[metric_folder]['layout'] == 'YF_M': #RobotStoppageLogs
+        file_path = os.sep.join([metric_folder_path,
                         str(year_folder),
                         str(file_name_prefix) + '_' + str(metric_folder) + 'Log_' + month_folder + '.csv'])
     return file_path
@@ -86,54 +120,1352 @@ def round_to_next_hour(t, delta=1):
                +datetime.timedelta(hours=delta))
 
 
-def expand_per_hours(orignal_series):
+def build_stoppage_lookup(planned_downtime_df):
     '''
-    Spreads the sum of downtimes per hour to a maximum of 60 minutes per hour.
-    arguments: a series of downtimes per hour (the total downtime of a stoppage that started on that hour).
-    returns: series of downtimes per hour, maximum 60 minutes per hour.
+    Builds the lookup index used to classify stoppages from the planned_downtime.csv table.
+    A minorStoppageReason of '*' works as a wildcard: it classifies every minor of that major
+    that is not listed explicitly.
+    arguments: DataFrame with majorStoppageReason, minorStoppageReason and classificationStoppageReason.
+    returns: (exact, wildcard) Series; exact is indexed by (major, minor) and wildcard by major.
     '''
-    fit_in_hour = [0] * orignal_series.size
-    for current_hour in range(orignal_series.size):
-        a = divmod(int(orignal_series[current_hour]), 60)
-        extra_whole_hours = a[0]
-        extra_minutes = a[1]
-        if extra_whole_hours == 0: # if doesn't overflow to the next hour, set the value for the hour
-            try:
-                fit_in_hour[current_hour] = fit_in_hour[current_hour] + orignal_series[current_hour]
-            except KeyError:
-                fit_in_hour[current_hour] = orignal_series[current_hour]
-        else: # if it overflows to the next hour, see how many hours worth of overtime and split by the next hous
-            for next_hour in range(current_hour, current_hour+extra_whole_hours):
-                try:
-                    fit_in_hour[next_hour] = fit_in_hour[next_hour] + 60
-                except KeyError:
-                    fit_in_hour[next_hour] = 60
+    is_wildcard = planned_downtime_df['minorStoppageReason'] == '*'
+    exact = planned_downtime_df.loc[~is_wildcard].drop_duplicates(
+        ['majorStoppageReason', 'minorStoppageReason'], keep='last').set_index(
+        ['majorStoppageReason', 'minorStoppageReason'])['classificationStoppageReason']
+    wildcard = planned_downtime_df.loc[is_wildcard].drop_duplicates(
+        'majorStoppageReason', keep='last').set_index('majorStoppageReason')['classificationStoppageReason']
+    return exact, wildcard
+
+
+def classify_stoppages(major, minor, lookup):
+    '''
+    Labels each stoppage as planned/non-planned with a single join on (Major, Minor0).
+    The pairs are reduced to categorical codes, so only the unique pairs are looked up in the index
+    and the labels are broadcast back to every row; unknown pairs are labelled 'no valid code'.
+    arguments: array-likes of Major and Minor0 reasons and the (exact, wildcard) lookup from build_stoppage_lookup.
+    returns: (categorical Series of downtime types, DataFrame with the unmatched pairs and their counts).
+    '''
+    exact, wildcard = lookup
+    major = pd.Categorical(major)
+    minor = pd.Categorical(minor)
+    # one integer code per (major, minor) pair; +1 keeps the missing values (code -1) apart
+    n_minor = len(minor.categories) + 1
+    pair_codes = (major.codes.astype(np.int64) + 1) * n_minor + (minor.codes.astype(np.int64) + 1)
+    # dense table of every possible pair: keeps only the ones that happened, without sorting the rows
+    pair_counts = np.bincount(pair_codes, minlength=(len(major.categories) + 1) * n_minor)
+    unique_codes = np.flatnonzero(pair_counts)
+    position = np.zeros(pair_counts.size, dtype=np.int64)
+    position[unique_codes] = np.arange(unique_codes.size)
+    codes = position[pair_codes]
+    unique_pairs = pd.MultiIndex(levels=[major.categories, minor.categories],
+                                 codes=[unique_codes // n_minor - 1, unique_codes % n_minor - 1],
+                                 names=['Major', 'Minor0'])
+    labels = pd.Series(exact.reindex(unique_pairs).values, index=unique_pairs)
+    labels = labels.fillna(pd.Series(wildcard.reindex(unique_pairs.get_level_values('Major')).values,
+                                     index=unique_pairs))
+    unmatched_pairs = labels.isna().values
+    labels = labels.fillna('no valid code') # is going to be counted as unplanned
+    labels = pd.Categorical(labels.values)
+    downtime_type = pd.Series(pd.Categorical.from_codes(labels.codes[codes], labels.categories), name='Downtime Type')
+    unmatched = unique_pairs[unmatched_pairs].to_frame(index=False)
+    unmatched['count'] = pair_counts[unique_codes][unmatched_pairs]
+    return downtime_type, unmatched
+
+
+def split_on_hours(starts, ends):
+    '''
+    Splits intervals on the hour boundaries they cross, in a single array pass.
+    Each interval is expanded into one piece per hour it touches (any length, including multi-day stops);
+    intervals that end before they start (or have no end) are kept as a single untouched piece.
+    arguments: array-likes of interval starts and ends (datetime64).
+    returns: (owner, piece_starts, piece_ends), where owner is the position of the original interval.
+    '''
+    starts = np.asarray(starts, dtype='datetime64[ns]')
+    ends = np.asarray(ends, dtype='datetime64[ns]')
+    valid = ends > starts # False for NaT as well
+    first_hour = starts.astype('datetime64[h]')
+    last_hour = np.where(valid, ends - np.timedelta64(1, 'ns'), starts).astype('datetime64[h]')
+    n_hours = (last_hour - first_hour).astype(np.int64) + 1
+    owner = np.repeat(np.arange(starts.size), n_hours)
+    # position of each piece inside its interval: 0 for the first hour, 1 for the next one, ...
+    offset = np.arange(owner.size) - np.repeat(np.cumsum(n_hours) - n_hours, n_hours)
+    hour_start = (first_hour[owner] + offset).astype('datetime64[ns]')
+    piece_starts = np.maximum(starts[owner], hour_start)
+    piece_ends = np.where(valid[owner], np.minimum(ends[owner], hour_start + np.timedelta64(1, 'h')), ends[owner])
+    return owner, piece_starts, piece_ends
+
+
+def merge_overlapping_intervals(starts, ends, priority):
+    '''
+    Sweep-line merge of intervals into a disjoint set of pieces, in O(n log n).
+    Every instant covered by one or more intervals goes to the covering interval with the smallest priority
+    (ties go to the first interval); an interval may therefore be cut in several pieces or disappear.
+    Intervals that end before they start (or have no start/end) cover nothing and are dropped.
+    arguments: array-likes of interval starts and ends (datetime64) and list of priority keys (comparable, e.g. tuples).
+    returns: (owner, piece_starts, piece_ends) sorted by piece start, where owner is the position of the original interval.
+    '''
+    starts = np.asarray(starts, dtype='datetime64[ns]')
+    ends = np.asarray(ends, dtype='datetime64[ns]')
+    valid = np.flatnonzero(ends > starts) # False for NaT as well
+    start_ns = starts.view(np.int64)
+    end_ns = ends.view(np.int64)
+    by_start = valid[np.argsort(start_ns[valid], kind='stable')].tolist()
+    start_list, end_list = start_ns.tolist(), end_ns.tolist()
+    owner, piece_starts, piece_ends = [], [], []
+    covering = [] # heap of (priority, position, end) of the intervals covering the current instant
+    i, t = 0, None
+    while i < len(by_start) or covering:
+        if not covering: # jumps the gap to the next interval
+            t = start_list[by_start[i]]
+        while i < len(by_start) and start_list[by_start[i]] <= t:
+            position = by_start[i]
+            heapq.heappush(covering, (priority[position], position, end_list[position]))
+            i += 1
+        while covering and covering[0][2] <= t: # intervals already reset
+            heapq.heappop(covering)
+        if not covering:
+            continue
+        position = covering[0][1]
+        next_t = covering[0][2] if i == len(by_start) else min(covering[0][2], start_list[by_start[i]])
+        if owner and owner[-1] == position and piece_ends[-1] == t: # same interval, continues the piece
+            piece_ends[-1] = next_t
+        else:
+            owner.append(position)
+            piece_starts.append(t)
+            piece_ends.append(next_t)
+        t = next_t
+    return (np.array(owner, dtype=np.int64), np.array(piece_starts, dtype=np.int64).view('datetime64[ns]'),
+            np.array(piece_ends, dtype=np.int64).view('datetime64[ns]'))
+
+
+def split_stoppages_on_hours(stoppages_df):
+    '''
+    Splits every stoppage that overflows to the next hour(s) into one row per hour.
+    e.g. 11:50 | 13:10 becomes 11:50 | 12:00, 12:00 | 13:00 and 13:00 | 13:10.
+    arguments: stoppages DataFrame with 'LPM DateTime' (start) and 'Rst DateTime' (end) columns.
+    returns: DataFrame with the same columns and one row per stoppage per hour.
+    '''
+    owner, piece_starts, piece_ends = split_on_hours(stoppages_df['LPM DateTime'], stoppages_df['Rst DateTime'])
+    split_df = stoppages_df.iloc[owner].reset_index(drop=True)
+    split_df['LPM DateTime'] = piece_starts
+    split_df['Rst DateTime'] = piece_ends
+    return split_df
+
+
+def allocate_downtime_per_hour(lpm_datetime, rst_datetime, downtime_type):
+    '''
+    Allocates the downtime of every stoppage to the hours it actually happened in.
+    Replaces the old split + groupby + expand_per_hours passes: intervals are split on the hour
+    boundaries and the seconds of each piece are summed per hour with np.bincount.
+    Stoppages with type 'planned' are planned downtime; everything else counts as unplanned.
+    arguments: array-likes of LPM DateTime (start), Rst DateTime (end) and Downtime Type.
+    returns: DataFrame indexed by the starting hour ('DateTime') with planned_seconds and unplanned_seconds.
+    '''
+    owner, piece_starts, piece_ends = split_on_hours(lpm_datetime, rst_datetime)
+    valid = piece_ends > piece_starts
+    seconds = np.where(valid, (piece_ends - piece_starts) / np.timedelta64(1, 's'), 0.0)
+    if not valid.any():
+        return pd.DataFrame({'planned_seconds': [], 'unplanned_seconds': []},
+                            index=pd.DatetimeIndex([], name='DateTime'))
+    hours = piece_starts.astype('datetime64[h]')
+    first_hour = hours[valid].min()
+    last_hour = hours[valid].max()
+    # pieces with no duration don't extend the hour range
+    slot = np.where(valid, hours - first_hour, 0).astype(np.int64)
+    n_slots = int((last_hour - first_hour).astype(np.int64)) + 1
+    planned = (np.asarray(downtime_type) == 'planned')[owner]
+    total_seconds = np.bincount(slot, weights=seconds, minlength=n_slots)
+    planned_seconds = np.bincount(slot, weights=np.where(planned, seconds, 0.0), minlength=n_slots)
+    index = pd.DatetimeIndex(np.arange(first_hour, last_hour + 1).astype('datetime64[ns]'), name='DateTime')
+    return pd.DataFrame({'planned_seconds': planned_seconds,
+                         'unplanned_seconds': total_seconds - planned_seconds}, index=index)
+
+
+def read_new_lines(file_path, offset=0, header='', max_bytes=None):
+    '''
+    Reads what was appended to a log file after a given byte offset, up to its last complete line
+    (a line the robot is still writing is left for the next run). The header of the file is put back
+    before the new lines, so they are parsed exactly like the whole file.
+    arguments: file path, byte offset (0 reads the whole file), header line (read from the file when offset is 0)
+    and max_bytes, to read at most that many bytes (the lines after it are left for the next read).
+    returns: (BytesIO with the header and the complete new lines, offset after the last complete line, header line).
+    '''
+    with open(file_path, 'rb') as file1:
+        file1.seek(offset)
+        new_bytes = file1.read(-1 if max_bytes is None else max_bytes)
+    if offset == 0:
+        header = new_bytes[:new_bytes.find(b'\n') + 1].decode()
+        new_bytes = new_bytes[len(header.encode()):]
+        offset = len(header.encode())
+    complete = new_bytes.rfind(b'\n') + 1
+    return io.BytesIO(header.encode() + new_bytes[:complete]), offset + complete, header
+
+
+def parse_datetime(values, datetime_formats):
+    '''
+    Converts a column to DateTime trying explicit formats in order, without format inference
+    (only values that match none of the formats are inferred).
+    arguments: series of strings and list of formats, e.g. ['%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M'].
+    returns: series of DateTime.
+    '''
+    parsed = pd.to_datetime(values, format=datetime_formats[0], errors='coerce')
+    for datetime_format in datetime_formats[1:] + [None]:
+        missing = parsed.isna() & values.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(values[missing], format=datetime_format,
+                                         errors='coerce' if datetime_format else 'raise')
+    return parsed
+
+
+def apply_schema(log_raw, schema):
+    '''
+    Renames the columns of a log to the names used in the ETL, converts the DateTime columns and adds the
+    optional columns missing in the file (empty), in the order of the schema.
+    arguments: DataFrame read with the dtypes of the schema and the schema (see directories).
+    returns: DataFrame.
+    '''
+    log_raw = log_raw.rename(columns={file_column: column for file_column, column, dtype in schema['columns']})
+    for file_column, column, dtype in schema['columns']:
+        if column not in log_raw:
+            log_raw[column] = pd.Series(pd.NA, index=log_raw.index, dtype=dtype)
+        elif dtype == 'datetime':
+            log_raw[column] = parse_datetime(log_raw[column], schema['datetime_formats'])
+    return log_raw[[column for file_column, column, dtype in schema['columns']]]
+
+
+def read_log(file, metric):
+    '''
+    Reads a robot log with the schema of its metric in directories: validates the header, reads each column
+    with its declared type (categoricals for reason codes and part/lot, Int32 counters), converts the DateTime
+    columns with the declared formats and names the columns as used in the ETL.
+    arguments: file path or buffer and metric (key of directories).
+    returns: DataFrame.
+    '''
+    schema = directories[metric]['schema']
+    header = pd.read_csv(file, nrows=0).columns.tolist()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    # the file may name a column as the robots team does (e.g. Reject1) or as the ETL does (e.g. Cable Rejects)
+    dtypes = dict()
+    for file_column, column, dtype in schema['columns']:
+        for name in (file_column, column):
+            dtypes[name] = str if dtype == 'datetime' else dtype
+    unknown_columns = [name for name in header if name not in dtypes]
+    missing_columns = [file_column for file_column, column, dtype in schema['columns'] if file_column not in header
+                       and column not in header and file_column not in schema['optional']]
+    if unknown_columns or missing_columns:
+        raise ValueError(metric + ' log header does not match its schema. Unknown columns: ' + str(unknown_columns) +
+                         ', missing columns: ' + str(missing_columns))
+    return apply_schema(pd.read_csv(file, dtype={name: dtypes[name] for name in header}), schema)
+
+
+def read_reject_data(file):
+    '''
+    Reads a RejectData log (see read_log).
+    arguments: file path or buffer.
+    returns: RejectData DataFrame.
+    '''
+    return read_log(file, 'RejectData')
+
+
+def read_robot_failure(file):
+    '''
+    Reads a RobotFailure log (see read_log).
+    arguments: file path or buffer.
+    returns: RobotFailure DataFrame.
+    '''
+    return read_log(file, 'RobotFailure')
+
+
+def read_export(file, schema, index_col=None):
+    '''
+    Reads back a table exported by the ETL (hourly output, rows carried in the checkpoint) with the types of the
+    log schema, e.g. Part # as text categories (a CSV would give floats, as hours with no data leave it empty).
+    arguments: file path or buffer, schema of the log the table comes from (see directories) and index_col.
+    returns: DataFrame; floats are read back exactly as they were exported.
+    '''
+    dtypes = {column: dtype for file_column, column, dtype in schema['columns'] if dtype != 'datetime'}
+    datetime_columns = [column for file_column, column, dtype in schema['columns'] if dtype == 'datetime']
+    header = pd.read_csv(file, nrows=0).columns
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    datetime_columns = [column for column in datetime_columns if column in header]
+    export = pd.read_csv(file, index_col=index_col, dtype={column: dtypes[column] for column in header if column in dtypes},
+                         parse_dates=datetime_columns, float_precision='round_trip')
+    # an empty table (e.g. no stoppage carried) has no value to parse: the DateTime columns would stay as text
+    return export.astype({column: 'datetime64[ns]' for column in datetime_columns})
+
+
+def cached_read(file_path, reader, cache_folder=None, max_bytes=None):
+    '''
+    Reads a log through the local parse cache. Parsed (typed) frames are stored in a binary format
+    (Feather if pyarrow is installed, pickle otherwise) keyed by the source path, size and modification time,
+    the log schemas and parse_cache_version, so an unchanged file is loaded without reading the network share
+    nor parsing it again; a changed file (or schema) is parsed again and its old entry deleted. Above max_bytes the least recently used entries are deleted.
+    arguments: path of the log, reader function (e.g. read_reject_data), cache folder and size cap
+    (default: parse_cache_folder and parse_cache_max_bytes).
+    returns: DataFrame, as returned by reader.
+    '''
+    cache_folder = parse_cache_folder if cache_folder is None else cache_folder
+    max_bytes = parse_cache_max_bytes if max_bytes is None else max_bytes
+    file_stat = os.stat(file_path)
+    source_key = hashlib.sha1((reader.__name__ + '|' + os.path.abspath(file_path)).encode()).hexdigest()
+    # frames parsed with another schema (see directories) or version of the readers are parsed again
+    schema_key = hashlib.sha1(json.dumps([parse_cache_version] + [directories[metric].get('schema')
+                                         for metric in sorted(directories)]).encode()).hexdigest()[:16]
+    entry_name = '_'.join([source_key, schema_key, str(file_stat.st_size), str(file_stat.st_mtime_ns)])
+    os.makedirs(cache_folder, exist_ok=True)
+    for extension, load in (('.feather', pd.read_feather), ('.pkl', pd.read_pickle)):
+        entry_path = os.path.join(cache_folder, entry_name + extension)
+        if os.path.exists(entry_path):
             try:
-                fit_in_hour[current_hour+extra_whole_hours] = fit_in_hour[current_hour+extra_whole_hours] + extra_minutes
-            except KeyError:
-                fit_in_hour[current_hour+extra_whole_hours] = extra_minutes
-    return pd.Series(fit_in_hour)
+                os.utime(entry_path) # marks as recently used
+                return load(entry_path)
+            except FileNotFoundError: # evicted meanwhile by another reader
+                pass
+
+    frame = reader(file_path)
+    # deletes the entries of previous versions of the same file
+    for cached_name in os.listdir(cache_folder):
+        if cached_name.startswith(source_key + '_'):
+            os.remove(os.path.join(cache_folder, cached_name))
+    entry_path = None
+    if pyarrow is not None:
+        try:
+            frame.to_feather(os.path.join(cache_folder, entry_name + '.feather.tmp'))
+            entry_path = os.path.join(cache_folder, entry_name + '.feather')
+        except (ValueError, TypeError, NotImplementedError): # e.g. columns with mixed types
+            if os.path.exists(os.path.join(cache_folder, entry_name + '.feather.tmp')):
+                os.remove(os.path.join(cache_folder, entry_name + '.feather.tmp'))
+    if entry_path is None:
+        entry_path = os.path.join(cache_folder, entry_name + '.pkl')
+        frame.to_pickle(entry_path + '.tmp')
+    os.replace(entry_path + '.tmp', entry_path)
+
+    # LRU eviction: deletes the entries used longer ago until the cache fits in max_bytes
+    # (entries deleted meanwhile by other readers, e.g. robots running in parallel, are skipped)
+    entries = []
+    for cached_name in os.listdir(cache_folder):
+        if cached_name.endswith('.tmp'):
+            continue
+        try:
+            cached_stat = os.stat(os.path.join(cache_folder, cached_name))
+        except FileNotFoundError:
+            continue
+        entries.append((cached_stat.st_mtime, cached_stat.st_size, os.path.join(cache_folder, cached_name)))
+    entries.sort()
+    cache_size = sum(cached_size for _, cached_size, _ in entries)
+    for _, cached_size, cached_path in entries:
+        if cache_size <= max_bytes or cached_path == entry_path:
+            break
+        cache_size -= cached_size
+        try:
+            os.remove(cached_path)
+        except FileNotFoundError:
+            pass
+    return frame
+
+
+def scan_folder(folder, catalog_cache):
+    '''
+    Lists a folder with os.scandir, reusing the listing in catalog_cache when the folder's modification time
+    didn't change (one stat instead of a listing over the network; past months never change).
+    arguments: folder path and catalog cache dictionary (updated in place).
+    returns: list of [name, is_folder] (empty when the folder doesn't exist).
+    '''
+    try:
+        folder_mtime = os.stat(folder).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    cached = catalog_cache.get(folder)
+    if cached is not None and cached['mtime_ns'] == folder_mtime:
+        return cached['entries']
+    with os.scandir(folder) as folder_entries:
+        entries = [[entry.name, entry.is_dir()] for entry in folder_entries]
+    catalog_cache[folder] = {'mtime_ns': folder_mtime, 'entries': entries}
+    return entries
+
+
+def load_catalog_cache(cache_path):
+    '''
+    returns: catalog cache dictionary saved by save_catalog_cache (empty when missing or unreadable).
+    '''
+    try:
+        with open(cache_path) as file1:
+            return json.load(file1)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_catalog_cache(catalog_cache, cache_path):
+    '''
+    Saves the catalog cache (written to a temporary file first, so a reader never sees half of it).
+    arguments: catalog cache dictionary and its path.
+    '''
+    with open(cache_path + '.' + str(os.getpid()) + '.tmp', 'w') as file1:
+        json.dump(catalog_cache, file1)
+    os.replace(cache_path + '.' + str(os.getpid()) + '.tmp', cache_path)
+
+
+def build_catalog(robot_folder_name, file_name_prefix, metric_folder, years=None, catalog_cache=None):
+    '''
+    Catalogs the files of a metric on the robot's share, following its layout in directories
+    (F_Y: one file per year; YF_M: Year folders with one file per month; YMF_D: Year/Month folders, one file per day).
+    arguments: robot folder, file name prefix, metric, years to catalog (None: every year found)
+    and catalog cache dictionary (see scan_folder; None doesn't cache).
+    returns: DataFrame with the 'date' (first day of the file) and 'path' of each file, sorted by date.
+    '''
+    catalog_cache = {} if catalog_cache is None else catalog_cache
+    layout = directories[metric_folder]['layout']
+    metric_path = get_metric_folder(robot_folder_name, metric_folder)
+    file_name_start = str(file_name_prefix) + '_' + str(metric_folder) + 'Log_'
+    year_filter = None if years is None else {str(year) for year in years}
+    # folders to list, with the part of the date they give: [(folder, year, month)]
+    if layout == 'F_Y':
+        folders = [(metric_path, None, None)]
+    else:
+        folders = [(os.sep.join([metric_path, name]), name, None) for name, is_folder in scan_folder(metric_path, catalog_cache)
+                   if is_folder and name.isdigit() and (year_filter is None or name in year_filter)]
+        if layout == 'YMF_D':
+            folders = [(os.sep.join([year_path, name]), year, name) for year_path, year, _ in folders
+                       for name, is_folder in scan_folder(year_path, catalog_cache) if is_folder]
+    catalog = []
+    for folder, year, month in folders:
+        for name, is_folder in scan_folder(folder, catalog_cache):
+            if is_folder or not fnmatch.fnmatch(name, file_name_start + '*.csv'):
+                continue
+            suffix = name[len(file_name_start):-len('.csv')]
+            try: # file name suffix: year (F_Y), month name (YF_M) or day (YMF_D)
+                if layout == 'F_Y':
+                    date = datetime.datetime(int(suffix), 1, 1)
+                elif layout == 'YF_M':
+                    date = datetime.datetime.strptime(year + ' ' + suffix, '%Y %B')
+                else:
+                    date = datetime.datetime.strptime(year + ' ' + month + ' ' + suffix, '%Y %B %d')
+            except ValueError: # not a log of this metric (e.g. a copy or a backup)
+                continue
+            if year_filter is None or str(date.year) in year_filter:
+                catalog.append((date, os.sep.join([folder, name])))
+    return pd.DataFrame(catalog, columns=['date', 'path']).sort_values('date', ignore_index=True)
+
+
+def start_run_log(robot_name, profile=False):
+    '''
+    Creates the run log of one ETL run, filled by instrument_stage and written by write_run_log.
+    arguments: robot name; profile=True runs every stage under cProfile and tracemalloc and keeps the slowest one.
+    returns: run log dictionary.
+    '''
+    return {'robot': robot_name, 'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'profile': profile, 'records': [], 'slowest': None}
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of the process so far (its high-water mark, not the peak of the current stage):
+    from resource on Linux / macOS, else the peak working set from psutil on Windows.
+    returns: MB (None when neither is available).
+    '''
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss / 1024 if os.uname().sysname != 'Darwin' else peak_rss / 1024**2 # KB on Linux, bytes on macOS
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss) / 1024**2 # peak_wset only exists on Windows
+    return None
+
+
+def rss_mb():
+    '''
+    returns: current resident memory of the process, in MB (None without psutil).
+    '''
+    return None if psutil is None else psutil.Process().memory_info().rss / 1024**2
+
+
+@contextlib.contextmanager
+def instrument_stage(run_log, stage, rows_in=None):
+    '''
+    Measures one stage of the ETL: wall time, CPU time, memory and rows in/out (set record['rows_out']
+    inside the block). A stage that raises is recorded with its error. With run_log=None nothing is recorded.
+    The memory is the peak RSS of the process so far (see peak_rss_mb), so a stage only shows its own peak when it
+    raises it; with psutil, 'rss_delta_mb' is what the stage left allocated (RSS after minus before the stage).
+    usage: with instrument_stage(run_log, 'dedup', len(df)) as record: ...; record['rows_out'] = len(new_df)
+    arguments: run log from start_run_log (or None), stage name and number of rows going in.
+    returns: (yields) the record of the stage.
+    '''
+    record = {'stage': stage, 'rows_in': rows_in, 'rows_out': None}
+    if run_log is None:
+        yield record
+        return
+    profiler = None
+    if run_log['profile']:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall_start, cpu_start, rss_start = time.perf_counter(), time.process_time(), rss_mb()
+    try:
+        yield record
+    except Exception as error:
+        record['error'] = repr(error)
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['rss_delta_mb'] = None if rss_start is None else rss_mb() - rss_start
+        if profiler is not None:
+            profiler.disable()
+            record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+            slowest = run_log['slowest']
+            if slowest is None or record['wall_seconds'] > slowest['wall_seconds']:
+                run_log['slowest'] = {'stage': stage, 'wall_seconds': record['wall_seconds'], 'profiler': profiler,
+                                      'snapshot': tracemalloc.take_snapshot()}
+            tracemalloc.stop()
+        run_log['records'].append(record)
+
+
+def write_run_log(run_log, run_log_path, profile_prefix=None):
+    '''
+    Appends the records of a run to the run log (JSON lines, one per stage) and, when the run was profiled,
+    dumps the slowest stage: <profile_prefix>_slowest_stage.prof (cProfile, open with pstats or snakeviz)
+    and <profile_prefix>_slowest_stage_memory.txt (top allocations from tracemalloc).
+    arguments: run log from start_run_log, path of the JSON lines file and prefix of the profile files.
+    '''
+    lines = ''.join(json.dumps(dict(robot=run_log['robot'], started_at=run_log['started_at'], **record)) + '\n'
+                    for record in run_log['records'])
+    with open(run_log_path, 'a') as file1: # one write per run, so runs of parallel robots don't interleave
+        file1.write(lines)
+    slowest = run_log['slowest']
+    if slowest is not None and profile_prefix is not None:
+        slowest['profiler'].dump_stats(profile_prefix + '_slowest_stage.prof')
+        with open(profile_prefix + '_slowest_stage_memory.txt', 'w') as file1:
+            file1.write('slowest stage: ' + slowest['stage'] + ' (' + str(round(slowest['wall_seconds'], 3)) + ' s)\n')
+            for statistic in slowest['snapshot'].statistics('lineno')[:25]:
+                file1.write(str(statistic) + '\n')
+
+
+def read_reject_weights(file_path='reject_weights.csv'):
+    '''
+    Reads the weight of each reject reason in 'Total Rejects' (reject_weights.csv: rejectReason, weight).
+    arguments: path of the file.
+    returns: Series of weights indexed by reject reason (names of the RejectData schema).
+    '''
+    reject_weights = pd.read_csv(file_path, encoding='utf-8-sig')
+    return pd.Series(reject_weights.iloc[:, 1].astype(float).values, index=reject_weights.iloc[:, 0].values)
+
+
+def read_target_rates(file_path='target_rates.csv'):
+    '''
+    Reads the target production rate of each part number (target_rates.csv: partNumber, targetPartsPerMinute).
+    arguments: path of the file.
+    returns: Series of target parts per minute indexed by part number (as text).
+    '''
+    target_rates = pd.read_csv(file_path, encoding='utf-8-sig', dtype=str)
+    return pd.Series(target_rates.iloc[:, 1].astype(float).values, index=target_rates.iloc[:, 0].str.strip().values)
+
+
+def calculate_total_rejects(RejectData_raw, reject_weights):
+    '''
+    Adds the 'Total Rejects' column to the RejectData table: weighted sum of the reject columns,
+    as a single matrix-vector product.
+    arguments: RejectData DataFrame and Series from read_reject_weights (indexed by names of reject_data_reasons).
+    returns: the same DataFrame, with 'Total Rejects'.
+    '''
+    # weights defined between engineering and design team to capture true bad parts only once.
+    # a misspelled reason would silently count as missing, making every total missing
+    unknown_reasons = [reason for reason in reject_weights.index if reason not in reject_data_reasons]
+    if unknown_reasons:
+        raise ValueError('Unknown reject reasons in the reject weights: ' + str(unknown_reasons) +
+                         ', use the names of reject_data_reasons')
+    # reasons with no weight are left out, so their missing values (older robot software) don't make the total missing
+    reject_weights = reject_weights[reject_weights != 0]
+    rejects = RejectData_raw.reindex(columns=reject_weights.index).to_numpy(dtype=float, na_value=np.nan)
+    RejectData_raw['Total Rejects'] = rejects @ reject_weights.to_numpy(dtype=float)
+    return RejectData_raw
+
+
+def add_downtime_type(RobotFailure_raw, stoppages_lookup, log_path="log.txt", logged_from=0):
+    '''
+    Adds the 'Downtime Type' column (planned, non-planned or no valid code) to the RobotFailure table
+    and appends the stoppages with no valid code to the log.
+    arguments: RobotFailure DataFrame, the lookup from build_stoppage_lookup, log path (None doesn't log) and
+    logged_from, position of the first row to log (the rows before it were already logged, e.g. carried over).
+    returns: the same DataFrame, with 'Downtime Type'.
+    '''
+    downtime_type, unmatched_stoppages = classify_stoppages(RobotFailure_raw['Major'], RobotFailure_raw['Minor0'],
+                                                            stoppages_lookup)
+    RobotFailure_raw['Downtime Type'] = downtime_type.values
+    if logged_from > 0: # only the unique pairs of the new rows are looked up again
+        unmatched_stoppages = classify_stoppages(RobotFailure_raw['Major'].iloc[logged_from:],
+                                                 RobotFailure_raw['Minor0'].iloc[logged_from:], stoppages_lookup)[1]
+    if len(unmatched_stoppages) > 0 and log_path is not None:
+        with open(log_path, 'a') as file1: # appends to a log
+            file1.write(str(unmatched_stoppages['count'].sum()) + " stoppages with no valid code at " +
+                        datetime.datetime.now().strftime('%x %X') + ': ' +
+                        '; '.join(unmatched_stoppages['Major'].astype(str) + ' / ' + unmatched_stoppages['Minor0'].astype(str) +
+                                  ' (' + unmatched_stoppages['count'].astype(str) + ')') + '\n')
+    return RobotFailure_raw
+
+
+def log_stoppages_with_no_duration(RobotFailure_raw, log_path="log.txt"):
+    '''
+    Appends to the log the stoppages that add no downtime: reset at or before their start
+    (e.g. a Rst DateTime logged as a bare date, 12/1/2022, read as midnight) or with no LPM / Rst DateTime.
+    arguments: RobotFailure DataFrame and log path (None doesn't log).
+    returns: number of stoppages with no duration.
+    '''
+    starts, ends = RobotFailure_raw['LPM DateTime'], RobotFailure_raw['Rst DateTime']
+    missing_time = starts.isna() | ends.isna()
+    inverted = ~missing_time & (ends <= starts)
+    no_duration = int(missing_time.sum() + inverted.sum())
+    if no_duration > 0 and log_path is not None:
+        first = RobotFailure_raw.loc[missing_time | inverted].iloc[0]
+        with open(log_path, 'a') as file1: # appends to a log
+            file1.write(str(no_duration) + " stoppages with no duration at " +
+                        datetime.datetime.now().strftime('%x %X') + ': ' + str(int(inverted.sum())) +
+                        " reset at or before their start, " + str(int(missing_time.sum())) + " with no LPM / Rst DateTime" +
+                        ' (first: ' + str(first['LPM DateTime']) + ' | ' + str(first['Rst DateTime']) + ')\n')
+    return no_duration
+
+
+def drop_repeated_stoppages(RobotFailure_raw, precedence=None):
+    '''
+    Merges repeated and overlapping stoppages into disjoint intervals (see merge_overlapping_intervals),
+    so no period is counted twice. When stoppages overlap, each instant goes to:
+       1) the stoppage whose Downtime Type comes first in precedence (default: overlap_precedence);
+       2) between stoppages of the same (or unlisted) type, the one reset first.
+    With no precedence, this keeps the meaning of the robot's logs: when the reason of a stoppage is changed,
+    a new row with the same start and a later reset is logged, so each reason lasts until its own reset
+    and the next one continues from there.
+    e.g. 10:00 | 10:05 unplanned and 10:00 | 10:30 planned become 10:00 | 10:05 unplanned and 10:05 | 10:30 planned.
+    arguments: classified RobotFailure DataFrame, in the order of the log (by Rst DateTime), and list of Downtime Types.
+    returns: new DataFrame with one row per disjoint piece, sorted by LPM DateTime; a stoppage may be split
+    in several pieces or dropped when fully covered by others.
+    '''
+    precedence = overlap_precedence if precedence is None else precedence
+    rank = {downtime_type: i for i, downtime_type in enumerate(precedence)}
+    downtime_rank = [rank.get(downtime_type, len(precedence)) for downtime_type in RobotFailure_raw['Downtime Type']]
+    reset = RobotFailure_raw['Rst DateTime'].values.astype('datetime64[ns]').view(np.int64).tolist()
+    owner, piece_starts, piece_ends = merge_overlapping_intervals(RobotFailure_raw['LPM DateTime'],
+                                                                  RobotFailure_raw['Rst DateTime'],
+                                                                  list(zip(downtime_rank, reset)))
+    RobotFailure_no_duplicates = RobotFailure_raw.iloc[owner].reset_index(drop=True)
+    RobotFailure_no_duplicates['LPM DateTime'] = piece_starts
+    RobotFailure_no_duplicates['Rst DateTime'] = piece_ends
+    return RobotFailure_no_duplicates
+
+
+def process_stoppages(RobotFailure_raw, stoppages_lookup, run_log=None, log_path="log.txt", logged_from=0):
+    '''
+    Classifies the stoppages, removes the repeated ones and allocates their downtime per hour.
+    arguments: RobotFailure DataFrame, the lookup from build_stoppage_lookup, optional run log (see instrument_stage),
+    log path of the stoppages with no valid code or no duration (see add_downtime_type and
+    log_stoppages_with_no_duration) and logged_from, position of the first row to log.
+    returns: (RobotFailure_no_duplicates, downtime_per_hour from allocate_downtime_per_hour).
+    '''
+    with instrument_stage(run_log, 'classify', len(RobotFailure_raw)) as record:
+        RobotFailure_raw = add_downtime_type(RobotFailure_raw.reset_index(drop=True), stoppages_lookup, log_path,
+                                             logged_from)
+        log_stoppages_with_no_duration(RobotFailure_raw.iloc[logged_from:], log_path)
+        record['rows_out'] = len(RobotFailure_raw)
+    with instrument_stage(run_log, 'dedup', len(RobotFailure_raw)) as record:
+        RobotFailure_no_duplicates = drop_repeated_stoppages(RobotFailure_raw)
+        record['rows_out'] = len(RobotFailure_no_duplicates)
+    with instrument_stage(run_log, 'spread', len(RobotFailure_no_duplicates)) as record:
+        downtime_per_hour = allocate_downtime_per_hour(RobotFailure_no_duplicates['LPM DateTime'],
+                                                       RobotFailure_no_duplicates['Rst DateTime'],
+                                                       RobotFailure_no_duplicates['Downtime Type'])
+        record['rows_out'] = len(downtime_per_hour)
+    return RobotFailure_no_duplicates, downtime_per_hour
+
+
+def build_manual_check_table(RobotFailure_no_duplicates_split):
+    '''
+    Adds the columns for debugging / manual check of the stoppages split per hour (all numeric):
+       'Minutes down at the hour' is the maximum number of minutes that stoppage could fit inside that hour.
+          If the the stoppage overflows to the next hour, it is NaN.
+       'max minutes to be absorbed' is similar to 'Minutes down at the hour', but it is set for all minutes
+          left, without a maximum.
+       'remainder left for future hours' is the difference between the total amount of time for that stoppage
+          and how much it can still be used on that very same hour (0 when it doesn't overflow)
+    note that 'max minutes to be absorbed' + 'remainder left for future hours' = total downtime for a given period.
+    arguments: DataFrame from split_stoppages_on_hours.
+    returns: DataFrame with the debugging columns, ready to be exported.
+    '''
+    RobotFailure_extra_columns=RobotFailure_no_duplicates_split.copy()
+
+    # POPULATE COLUMNS FOR DOWNTIME MEASUREMENT
+    # taking only the minutes doesn't return enought granularity. Taking the decimal from sec
+    start_minute = (RobotFailure_extra_columns['LPM DateTime'].dt.minute +
+                    RobotFailure_extra_columns['LPM DateTime'].dt.second / 60).to_numpy()
+    end_minute = (RobotFailure_extra_columns['Rst DateTime'].dt.minute +
+                  RobotFailure_extra_columns['Rst DateTime'].dt.second / 60).to_numpy()
+    RobotFailure_extra_columns['time_per_stop'] = RobotFailure_extra_columns['Rst DateTime'] - RobotFailure_extra_columns['LPM DateTime']
+    minutes_per_stop = (RobotFailure_extra_columns['time_per_stop'] / np.timedelta64(1, 'm')).to_numpy()
+    overflow = start_minute + minutes_per_stop >= 60
+
+    RobotFailure_extra_columns['Minutes down at the hour'] = np.where(overflow, np.nan, end_minute - start_minute)
+    RobotFailure_extra_columns['max minutes to be absorbed'] = np.where(overflow, 60 - start_minute,
+                                                                        end_minute - start_minute)
+    RobotFailure_extra_columns['remainder left for future hours'] = np.where(overflow,
+                                                                             minutes_per_stop - (60 - start_minute), 0.0)
+
+    RobotFailure_reordered = RobotFailure_extra_columns[['LPM DateTime', 'Rst DateTime',  'Downtime Type', 'time_per_stop',
+                                                'Minutes down at the hour', 'max minutes to be absorbed',
+                                                'remainder left for future hours', 'Detail', 'Major', 'Minor0', 'Part#', 'Lot#']]
+    return RobotFailure_reordered
+
+
+def manual_check_table(RobotFailure_no_duplicates, start=None, end=None):
+    '''
+    Builds the manual check table (see build_manual_check_table) on demand, only for the stoppages of a time window,
+    so debugging an hour doesn't require splitting the whole year.
+    arguments: DataFrame from drop_repeated_stoppages and window start and end (None: no limit).
+    returns: manual check DataFrame with the pieces starting inside [start, end).
+    '''
+    in_window = np.ones(len(RobotFailure_no_duplicates), dtype=bool)
+    if start is not None:
+        in_window &= (RobotFailure_no_duplicates['Rst DateTime'] > pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        in_window &= (RobotFailure_no_duplicates['LPM DateTime'] < pd.Timestamp(end)).to_numpy()
+    # When any interval goes after the hour (e.g. 7:50 to 9:10), split it in one piece per hour:
+    '''
+    # 11:50 | 13:50 (original row)
+    #       V
+    # 11:50 | 12:00 (first piece)
+    # 12:00 | 13:00 (whole hour)
+    # 13:00 | 13:50 (last piece)
+    '''
+    RobotFailure_no_duplicates_split = split_stoppages_on_hours(RobotFailure_no_duplicates.loc[in_window])
+    in_window = np.ones(len(RobotFailure_no_duplicates_split), dtype=bool)
+    if start is not None:
+        in_window &= (RobotFailure_no_duplicates_split['LPM DateTime'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        in_window &= (RobotFailure_no_duplicates_split['LPM DateTime'] < pd.Timestamp(end)).to_numpy()
+    return build_manual_check_table(RobotFailure_no_duplicates_split.loc[in_window].reset_index(drop=True))
+
+
+def round_reject_hours(RejectData_raw):
+    '''
+    Rounds hours if in between two hours, in a single array pass over the hours floored to the hour.
+    arguments: RejectData DataFrame.
+    returns: copy of the DataFrame with the DateTime rounded down to the hour where it doesn't clash with its neighbours.
+    '''
+    RejectData_sum_hour_rounded = RejectData_raw.copy()
+    date_time = RejectData_sum_hour_rounded['DateTime'].values.astype('datetime64[ns]')
+    hour = date_time.astype('datetime64[h]').astype('datetime64[ns]') # same as round_to_next_hour(t, 0)
+    # to be changed, that hour must be different than that rounded hour AND
+    # if i rounded value is bigger than rounded previous but smaller than rounded next
+    # as to avoid 4:05 and 4:06 receiving the same data when merging this df with data.
+    # The first and last rows have no neighbour on one side and are never rounded (NaT never compares true).
+    rounded = np.zeros(date_time.size, dtype=bool)
+    rounded[1:-1] = (date_time[1:-1] != hour[1:-1]) & (hour[:-2] < hour[1:-1]) & (hour[1:-1] < hour[2:])
+    RejectData_sum_hour_rounded['DateTime'] = np.where(rounded, hour, date_time)
+    return RejectData_sum_hour_rounded
+
+
+def downtime_minutes_per_hour(downtime_per_hour):
+    '''
+    Converts the downtime per hour in total and planned minutes per hour.
+    arguments: DataFrame from allocate_downtime_per_hour.
+    returns: DataFrame with total_down_minutes and total_planned_minutes, indexed by the hour at the end of
+    the period (shifted by one to match RejectData, which logs the production at the end of the hour).
+    '''
+    minutes_per_hour = pd.DataFrame({
+        'total_down_minutes': (downtime_per_hour['planned_seconds'] + downtime_per_hour['unplanned_seconds']) / 60,
+        'total_planned_minutes': downtime_per_hour['planned_seconds'] / 60})
+    minutes_per_hour.index = minutes_per_hour.index + datetime.timedelta(hours=1) # shifts index by one to match other files
+    return minutes_per_hour
+
+
+def merge_downtime(RejectData_sum_hour_rounded, minutes_per_hour):
+    '''
+    Merges RejectData, total downtime, and planned downtime. Unplanned downtime is the difference between total and planned.
+    Making the difference instead of a sum ensures there will be no instance of more than 60 minutes stopped per hour.
+    Fills NaN with 0s to avoid the blanks in the end of the columns.
+    arguments: DataFrame from round_reject_hours and DataFrame from downtime_minutes_per_hour.
+    returns: RejectData with total_down_minutes, total_planned_minutes and total_unplanned_minutes.
+    '''
+    RejectData_sum_hour = RejectData_sum_hour_rounded.merge(minutes_per_hour.rename_axis('DateTime').reset_index(),
+                                                            on=['DateTime', 'DateTime'], how='left')
+    RejectData_sum_hour['total_planned_minutes']=RejectData_sum_hour['total_planned_minutes'].fillna(0)
+    RejectData_sum_hour['total_down_minutes']=RejectData_sum_hour['total_down_minutes'].fillna(0)
+    RejectData_sum_hour['total_unplanned_minutes'] = RejectData_sum_hour['total_down_minutes'] - RejectData_sum_hour['total_planned_minutes']
+    RejectData_sum_hour['total_unplanned_minutes']=RejectData_sum_hour['total_unplanned_minutes'].fillna(0)
+    return RejectData_sum_hour
+
+
+def fill_missing_hours(RejectData_sum_hour, first_hour=None):
+    '''
+    Fills the missing hours with empty rows, so there is one row per hour (missing values are exported as N/A).
+    arguments: DataFrame from merge_downtime; first_hour of the range (default: the hour after the first row).
+    returns: DataFrame with every hour of the range sorted by DateTime, without the last row (it doesn't contain relevant data).
+    '''
+    if RejectData_sum_hour['DateTime'].isna().all(): # no RejectData row (e.g. a log with only its header): no hour
+        return RejectData_sum_hour.iloc[:0].reset_index(drop=True)
+    if first_hour is None:
+        first_hour = round_to_next_hour(RejectData_sum_hour['DateTime'].min())
+    # creates a temporary df with the range of the original one to later merge it with original
+    df = pd.DataFrame(pd.date_range(first_hour,\
+            round_to_next_hour(RejectData_sum_hour['DateTime'].max(),0),freq='H'),columns= ['DateTime'])\
+                .merge(RejectData_sum_hour,on=['DateTime'],how='outer',sort=True)
+    df.drop(df.tail(1).index,inplace=True) # as last row doesn't contain relevant data
+    return df
+
+
+def divide_or_nan(numerator, denominator):
+    '''
+    Element-wise division that returns NaN where the denominator is 0, negative or missing (no Python branching).
+    arguments: arrays of numerators and denominators.
+    returns: array of ratios.
+    '''
+    return np.divide(numerator, denominator, out=np.full(numerator.shape, np.nan), where=denominator > 0)
+
+
+def add_oee(hourly, target_rates):
+    '''
+    Adds the OEE of each hour (see module docstring), as array expressions over the whole table:
+       'Target Parts' = target rate of the part number * minutes running (60 - total down);
+       availability = minutes running / planned production minutes (60 - planned);
+       performance = parts made / target parts; quality = (parts made - total rejects) / parts made;
+       oee = availability * performance * quality.
+    Hours with no planned production time, no target rate or no parts made get NaN for that component.
+    arguments: hourly DataFrame and Series from read_target_rates.
+    returns: the same DataFrame, with 'Target Parts', availability, performance, quality and oee.
+    '''
+    total_down_minutes = hourly['total_down_minutes'].to_numpy(dtype=float, na_value=np.nan)
+    total_planned_minutes = hourly['total_planned_minutes'].to_numpy(dtype=float, na_value=np.nan)
+    parts_made = hourly['Parts Made'].to_numpy(dtype=float, na_value=np.nan)
+    total_rejects = hourly['Total Rejects'].to_numpy(dtype=float, na_value=np.nan)
+    # target rate looked up once per part number, then spread to the hours by the categorical codes
+    part_number = hourly['Part #'].astype('category')
+    categories = pd.Series(part_number.cat.categories.astype(object))
+    # part numbers read as numbers (e.g. 123456.0 from a CSV) are looked up by the text of the integer
+    is_number = categories.map(lambda category: isinstance(category, (int, float, np.number))).to_numpy(dtype=bool)
+    part_keys = categories.astype(str).str.strip()
+    part_keys[is_number] = categories[is_number].astype(float).astype(np.int64).astype(str)
+    category_rates = part_keys.map(target_rates).to_numpy(dtype=float)
+    target_rate = np.append(category_rates, np.nan)[part_number.cat.codes.to_numpy()] # code -1 (missing) is NaN
+
+    running_minutes = 60 - total_down_minutes
+    hourly['Target Parts'] = target_rate * running_minutes
+    hourly['availability'] = divide_or_nan(running_minutes, 60 - total_planned_minutes)
+    hourly['performance'] = divide_or_nan(parts_made, hourly['Target Parts'].to_numpy())
+    hourly['quality'] = divide_or_nan(parts_made - total_rejects, parts_made)
+    hourly['oee'] = hourly['availability'] * hourly['performance'] * hourly['quality']
+    return hourly
+
+
+def build_hourly_table(RejectData_raw, minutes_per_hour, reject_weights, first_hour=None, run_log=None):
+    '''
+    Builds the hourly table: production and rejects from RejectData with the downtime of each hour.
+    arguments: RejectData DataFrame, DataFrame from downtime_minutes_per_hour, Series from read_reject_weights,
+    optional first_hour (see fill_missing_hours) and optional run log (see instrument_stage).
+    returns: hourly DataFrame.
+    '''
+    with instrument_stage(run_log, 'merge', len(RejectData_raw)) as record:
+        RejectData_raw = calculate_total_rejects(RejectData_raw, reject_weights)
+        RejectData_sum_hour_rounded = round_reject_hours(RejectData_raw)
+        RejectData_sum_hour = merge_downtime(RejectData_sum_hour_rounded, minutes_per_hour)
+        record['rows_out'] = len(RejectData_sum_hour)
+    with instrument_stage(run_log, 'fill hours', len(RejectData_sum_hour)) as record:
+        df = fill_missing_hours(RejectData_sum_hour, first_hour)
+        record['rows_out'] = len(df)
+    return df
+
+
+def rollup_bucket(period_start, level):
+    '''
+    Finds the rollup bucket (shift, day, ISO week or month) of each hour.
+    arguments: DatetimeIndex/Series of the start of the hours and level ('shift', 'day', 'week' or 'month').
+    returns: DatetimeIndex with the start of the bucket (shifts start at shift_start_hours, weeks on Monday).
+    '''
+    period_start = pd.DatetimeIndex(period_start)
+    if level == 'day':
+        return period_start.floor('D')
+    if level == 'week':
+        return period_start.floor('D') - pd.to_timedelta(period_start.dayofweek, unit='D')
+    if level == 'month':
+        return period_start.to_period('M').to_timestamp()
+    # shifts: hours since the first shift of the day, the night shift belongs to the day it started
+    first_shift = min(shift_start_hours)
+    shift_offsets = np.array(sorted(hour - first_shift for hour in shift_start_hours))
+    since_first_shift = period_start - datetime.timedelta(hours=first_shift)
+    shift = np.searchsorted(shift_offsets, since_first_shift.hour, side='right') - 1
+    return since_first_shift.floor('D') + pd.to_timedelta(shift_offsets[shift] + first_shift, unit='h')
+
+
+def compute_rollup(hourly, level):
+    '''
+    Sums the hourly table per bucket and computes the OEE components (see module docstring) of each bucket:
+       availability = (scheduled - total down) / (scheduled - planned), with 60 scheduled minutes per distinct hour
+       with data;
+       performance = parts made / target parts ('Target Parts' column, NaN when the hourly table doesn't have it);
+       quality = (parts made - total rejects) / parts made; oee = availability * performance * quality.
+    arguments: hourly DataFrame (DateTime at the end of the hour) and level (see rollup_bucket).
+    returns: DataFrame indexed by the start of the bucket ('Bucket').
+    '''
+    # an hour can have several rows: rows logged at the same DateTime (each one merged with the downtime of that hour)
+    # and rows not rounded (e.g. 4:05 next to 4:06); each hour is scheduled and its downtime counted only once
+    has_data = hourly['Parts Made'].notna().to_numpy()
+    first_of_hour = has_data & ~hourly['DateTime'].dt.floor('h').where(has_data).duplicated().to_numpy()
+    first_of_datetime = ~hourly['DateTime'].duplicated().to_numpy()
+    sums = pd.DataFrame({
+        'hours': first_of_hour.astype(np.int64),
+        'parts_made': hourly['Parts Made'].astype(float).values,
+        'total_rejects': hourly['Total Rejects'].astype(float).values,
+        'total_down_minutes': np.where(first_of_datetime, hourly['total_down_minutes'], 0),
+        'total_planned_minutes': np.where(first_of_datetime, hourly['total_planned_minutes'], 0),
+        'total_unplanned_minutes': np.where(first_of_datetime, hourly['total_unplanned_minutes'], 0),
+        'target_parts': hourly['Target Parts'].astype(float).values if 'Target Parts' in hourly else np.nan})
+    # DateTime is the end of the hour (see downtime_minutes_per_hour), buckets are by the start of the hour
+    buckets = rollup_bucket(hourly['DateTime'] - datetime.timedelta(hours=1), level)
+    rollup = sums.groupby(buckets.rename('Bucket')).sum(min_count=1)
+    rollup['hours'] = rollup['hours'].fillna(0).astype(np.int64)
+    scheduled_minutes = rollup['hours'] * 60
+    rollup['availability'] = (scheduled_minutes - rollup['total_down_minutes']) / \
+                             (scheduled_minutes - rollup['total_planned_minutes'])
+    rollup['performance'] = rollup['parts_made'] / rollup['target_parts']
+    rollup['quality'] = (rollup['parts_made'] - rollup['total_rejects']) / rollup['parts_made']
+    rollup['oee'] = rollup['availability'] * rollup['performance'] * rollup['quality']
+    return rollup
+
+
+def update_rollups(rollups, hourly, changed_hours=None):
+    '''
+    Keeps the rollup tables up to date: only the buckets containing changed hours are recomputed
+    (from the hourly rows of those buckets) and replaced; the other buckets are kept as they are.
+    arguments: dictionary {level: rollup DataFrame} (None or missing levels are rebuilt from scratch),
+    complete hourly DataFrame and DateTimes (end of the hour) of the changed hours (None rebuilds everything).
+    returns: dictionary {level: rollup DataFrame}, sorted by bucket.
+    '''
+    rollups = {} if rollups is None else dict(rollups)
+    for level in rollup_levels:
+        if changed_hours is None or rollups.get(level) is None:
+            rollups[level] = compute_rollup(hourly, level)
+            continue
+        touched = rollup_bucket(pd.DatetimeIndex(changed_hours) - datetime.timedelta(hours=1), level).unique()
+        if len(touched) == 0:
+            continue
+        in_touched = rollup_bucket(hourly['DateTime'] - datetime.timedelta(hours=1), level).isin(touched)
+        rollups[level] = pd.concat([rollups[level].loc[~rollups[level].index.isin(touched)],
+                                    compute_rollup(hourly.loc[in_touched], level)]).sort_index()
+    return rollups
+
+
+def save_rollups(rollups, rollup_prefix):
+    '''
+    Exports each rollup table to <rollup_prefix>_rollup_<level>.csv.
+    arguments: dictionary {level: rollup DataFrame} and prefix of the files (e.g. robot name).
+    '''
+    for level, rollup in rollups.items():
+        rollup.to_csv(rollup_prefix + '_rollup_' + level + '.csv', na_rep='N/A')
+
+
+def load_rollups(rollup_prefix):
+    '''
+    Loads the rollup tables exported by save_rollups.
+    arguments: prefix of the files (e.g. robot name).
+    returns: dictionary {level: rollup DataFrame indexed by bucket}; None when any level is missing.
+    '''
+    rollups = {}
+    for level in rollup_levels:
+        rollup_path = rollup_prefix + '_rollup_' + level + '.csv'
+        if not os.path.exists(rollup_path):
+            return None
+        rollups[level] = pd.read_csv(rollup_path, index_col='Bucket', parse_dates=['Bucket'], na_values=['N/A'])
+    return rollups
+
+
+def month_to_date_oee(rollups, month):
+    '''
+    Looks up the OEE of a month so far (constant time: one index lookup on the month rollup).
+    arguments: dictionary {level: rollup DataFrame} of one robot and any DateTime in the month.
+    returns: Series with the sums and OEE components of the month (NaN when there is no data for it).
+    '''
+    month_start = pd.Timestamp(month).to_period('M').to_timestamp()
+    if month_start not in rollups['month'].index:
+        return pd.Series(np.nan, index=rollups['month'].columns, name=month_start)
+    return rollups['month'].loc[month_start]
+
+
+def hourly_store_rows(hourly):
+    '''
+    Converts the hourly table to the rows of the hourly store: DateTime as 'YYYY-MM-DD HH:MM:SS' text ('hour'),
+    the columns typed by reject_data_schema as text (category, e.g. Part #, keeping its leading zeros) or integers
+    (Int32) and the columns computed by the ETL as floats, with None for the missing values; the types don't depend
+    on the values, so the same hour gives the same row from a run or read back from the CSV output.
+    Rows logged at the same DateTime (RejectData rows that are not rounded, see round_reject_hours) are numbered by 'seq'.
+    arguments: hourly DataFrame.
+    returns: (DataFrame of the rows, dictionary {column: SQLite type}, Series of int64 hashes of each row).
+    '''
+    rows = pd.DataFrame({'hour': hourly['DateTime'].dt.strftime('%Y-%m-%d %H:%M:%S').values,
+                         'seq': hourly.groupby('DateTime').cumcount().values})
+    schema_types = {name: {'category': 'TEXT', 'Int32': 'INTEGER'}.get(dtype, 'TEXT')
+                    for _, name, dtype in reject_data_schema['columns']}
+    column_types = {}
+    for column in hourly.columns.drop('DateTime'):
+        values = hourly[column]
+        column_types[column] = schema_types.get(column, 'REAL') # Total Rejects, downtime minutes and OEE
+        if column_types[column] == 'TEXT':
+            rows[column] = values.astype(object).where(values.notna(), None).map(
+                lambda value: value if value is None else str(value)).values
+        else: # integers are hashed and written as floats too (SQLite stores 5.0 in an INTEGER column as 5)
+            rows[column] = values.astype(float).values
+    row_hash = pd.util.hash_pandas_object(rows, index=False).values.view(np.int64)
+    return rows, column_types, pd.Series(row_hash, index=pd.MultiIndex.from_frame(rows[['hour', 'seq']]))
+
+
+def write_hourly_store(hourly, robot_name, store_path, changed_hours=None):
+    '''
+    Upserts the hourly table of one robot into the SQLite hourly store, table 'hourly' keyed by (robot, hour, seq)
+    and indexed by hour. Only the rows that changed since the last write (compared by a hash of the row)
+    are written, and the rows of the robot no longer in the table within its time range are deleted, all in
+    one transaction: rerunning with the same table writes nothing. Columns missing in the store are added.
+    arguments: hourly DataFrame, robot name, path of the SQLite file (created if needed) and changed_hours,
+    DateTimes of the only hours to compare and write (e.g. from update_hourly; None: every hour of the table).
+    returns: number of rows written (inserted, replaced or deleted).
+    '''
+    if changed_hours is not None:
+        if len(changed_hours) == 0:
+            return 0
+        hourly = hourly.loc[hourly['DateTime'].isin(changed_hours)]
+        hours = pd.DatetimeIndex(changed_hours).strftime('%Y-%m-%d %H:%M:%S')
+    rows, column_types, row_hash = hourly_store_rows(hourly)
+    quote = lambda name: '"' + name.replace('"', '""') + '"'
+    connection = sqlite3.connect(store_path, timeout=60, isolation_level=None)
+    try:
+        connection.execute('BEGIN IMMEDIATE') # robots run in parallel processes write to the same file
+        connection.execute('CREATE TABLE IF NOT EXISTS hourly (robot TEXT NOT NULL, hour TEXT NOT NULL, '
+                           'seq INTEGER NOT NULL, row_hash INTEGER, PRIMARY KEY (robot, hour, seq))')
+        connection.execute('CREATE INDEX IF NOT EXISTS hourly_hour ON hourly (hour)')
+        stored_columns = {column_info[1] for column_info in connection.execute('PRAGMA table_info(hourly)')}
+        for column, column_type in column_types.items():
+            if column not in stored_columns:
+                connection.execute('ALTER TABLE hourly ADD COLUMN ' + quote(column) + ' ' + column_type)
+
+        # compares with what is stored for the robot in the time range of the table (or in the changed hours)
+        if changed_hours is None:
+            first_hour, last_hour = rows['hour'].min(), rows['hour'].max()
+        else:
+            first_hour, last_hour = hours.min(), hours.max()
+        stored_hash = pd.DataFrame(connection.execute(
+            'SELECT hour, seq, row_hash FROM hourly WHERE robot = ? AND hour >= ? AND hour <= ?',
+            (robot_name, first_hour, last_hour)).fetchall(), columns=['hour', 'seq', 'row_hash'])
+        if changed_hours is not None:
+            stored_hash = stored_hash.loc[stored_hash['hour'].isin(hours)]
+        stored_hash = stored_hash.set_index(['hour', 'seq'])['row_hash']
+        changed = (row_hash != stored_hash.reindex(row_hash.index)).values
+        removed = stored_hash.index.difference(row_hash.index)
+
+        rows_changed = rows.loc[changed].astype(object)
+        rows_changed.insert(0, 'robot', robot_name)
+        rows_changed['row_hash'] = row_hash.values[changed].tolist()
+        rows_changed = rows_changed.where(rows_changed.notna(), None)
+        connection.executemany('INSERT OR REPLACE INTO hourly (' + ', '.join(map(quote, rows_changed.columns)) +
+                               ') VALUES (' + ', '.join('?' * rows_changed.shape[1]) + ')',
+                               rows_changed.itertuples(index=False, name=None))
+        connection.executemany('DELETE FROM hourly WHERE robot = ? AND hour = ? AND seq = ?',
+                               [(robot_name, hour, int(seq)) for hour, seq in removed])
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return int(changed.sum()) + len(removed)
+
+
+def read_hourly_store(store_path, robot_name=None, start=None, end=None):
+    '''
+    Reads a time range of the hourly store without loading the rest of it (uses the index on hour).
+    usage: df = read_hourly_store('hourly_store.sqlite', 'RB17', '2022-12-01', '2022-12-02')
+    arguments: path of the SQLite file, robot name (None: every robot) and DateTimes of the range:
+    from start (included) to end (excluded), None for no limit.
+    returns: DataFrame with 'Robot', 'DateTime' and the columns of the hourly table, sorted by robot and DateTime.
+    '''
+    conditions, parameters = [], []
+    for condition, value in [('robot = ?', robot_name), ('hour >= ?', start), ('hour < ?', end)]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value if condition == 'robot = ?' else
+                              pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S'))
+    connection = sqlite3.connect(store_path, timeout=60)
+    try:
+        df = pd.read_sql_query('SELECT * FROM hourly' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') +
+                               ' ORDER BY robot, hour, seq', connection, params=parameters)
+    finally:
+        connection.close()
+    df = df.drop(columns=['seq', 'row_hash']).rename(columns={'robot': 'Robot', 'hour': 'DateTime'})
+    df['DateTime'] = pd.to_datetime(df['DateTime'], format='%Y-%m-%d %H:%M:%S')
+    return df
+
+
+def load_checkpoint(checkpoint_path, output_path, file_paths):
+    '''
+    Loads the checkpoint of the incremental mode, if it is still valid for the given logs and output.
+    It is discarded when the output was changed by someone else, a log path changed (e.g. new year file)
+    or a log is smaller than the offset already read (log was rotated or rewritten).
+    arguments: checkpoint path, hourly output path and dictionary {metric: log path}.
+    returns: checkpoint dictionary, or None when a full run is needed.
+    '''
+    if not (os.path.exists(checkpoint_path) and os.path.exists(output_path)):
+        return None
+    with open(checkpoint_path) as file1:
+        checkpoint = json.load(file1)
+    if checkpoint['output_size'] != os.path.getsize(output_path):
+        return None
+    for metric, file_path in file_paths.items():
+        if checkpoint[metric]['path'] != file_path or os.path.getsize(file_path) < checkpoint[metric]['offset']:
+            return None
+    return checkpoint
+
+
+def update_hourly(state, RejectData_new, RobotFailure_new, stoppages_lookup, reject_weights, target_rates,
+                  run_log=None, log_path="log.txt"):
+    '''
+    Applies new RejectData and RobotFailure rows to the hourly table, recomputing only the hours they affect
+    (shared by the incremental mode and the watch mode). The state keeps the last rows still open to merging /
+    rounding against the next ones: the RejectData rows from the cut hour (all recomputed by the next update)
+    plus the one before it, their neighbour when rounding (see round_reject_hours), and the stoppages reset in the last incremental_overlap_hours, so the next stoppages are merged with them; plus the
+    downtime of the hours from the cut (last hour of the previous update), which are going to be recomputed.
+    arguments: state dictionary ('hourly', 'RejectData_carry', 'RobotFailure_carry', 'carry_from', 'cut_hour' and
+    'pending_downtime', all None before the first update; updated in place), new rows from read_reject_data and
+    read_robot_failure (None when there are none), lookup from build_stoppage_lookup, reject weights, target rates,
+    optional run log (see instrument_stage) and log_path of the warnings.
+    returns: (hourly DataFrame, DateTimes of the changed hours; None when every hour is new).
+    '''
+    if RobotFailure_new is not None and state['carry_from'] is not None and \
+       RobotFailure_new['LPM DateTime'].min() < state['carry_from']:
+        with open(log_path, 'a') as file1: # appends to a log
+            file1.write("Stoppage starting before " + str(state['carry_from']) + " logged at " +
+                        datetime.datetime.now().strftime('%x %X') + ": overlaps with older stoppages are not merged, "
+                        "increase incremental_overlap_hours or delete the checkpoint for a full run\n")
+    RobotFailure_carry = state['RobotFailure_carry']
+    RejectData_window = pd.concat([state['RejectData_carry'], RejectData_new], ignore_index=True)
+    RobotFailure_window = pd.concat([RobotFailure_carry, RobotFailure_new], ignore_index=True)
+
+    # DOWNTIME: NEW STOPPAGES MINUS WHAT THE CARRIED ONES HAD ALREADY ADDED #
+    logged_from = 0 if RobotFailure_carry is None else len(RobotFailure_carry) # the carried stoppages were logged already
+    RobotFailure_no_duplicates, downtime_per_hour = process_stoppages(RobotFailure_window, stoppages_lookup, run_log,
+                                                                      log_path, logged_from)
+    delta_minutes = downtime_minutes_per_hour(downtime_per_hour)
+    if RobotFailure_carry is not None:
+        delta_minutes = delta_minutes.subtract(downtime_minutes_per_hour(allocate_downtime_per_hour(
+            RobotFailure_carry['LPM DateTime'], RobotFailure_carry['Rst DateTime'],
+            RobotFailure_carry['Downtime Type'])), fill_value=0)
+    minutes_per_hour = delta_minutes
+    if state['pending_downtime'] is not None:
+        minutes_per_hour = state['pending_downtime'].add(delta_minutes, fill_value=0)
+
+    # RECOMPUTES THE HOURS FROM THE CUT AND MERGES THEM WITH THE PREVIOUS ONES #
+    changed_hours = None # every hour, on the first update
+    if state['cut_hour'] is None:
+        df = build_hourly_table(RejectData_window, minutes_per_hour, reject_weights, run_log=run_log)
+    else:
+        cut_hour = state['cut_hour']
+        hourly_window = build_hourly_table(RejectData_window, minutes_per_hour, reject_weights, first_hour=cut_hour,
+                                           run_log=run_log)
+        df = state['hourly'].loc[state['hourly']['DateTime'] < cut_hour].copy() # the previous table is not changed
+        # stoppages logged late can still change hours already in the output
+        correction = df[['DateTime']].merge(delta_minutes.rename_axis('DateTime').reset_index(),
+                                            on='DateTime', how='left').fillna(0)
+        df['total_down_minutes'] = df['total_down_minutes'] + correction['total_down_minutes'].values
+        df['total_planned_minutes'] = df['total_planned_minutes'] + correction['total_planned_minutes'].values
+        df['total_unplanned_minutes'] = df['total_down_minutes'] - df['total_planned_minutes']
+        df = pd.concat([df, hourly_window.loc[hourly_window['DateTime'] >= cut_hour]], ignore_index=True)
+        changed_hours = pd.DatetimeIndex(df.loc[df['DateTime'] >= cut_hour, 'DateTime']).union(delta_minutes.index)
+    with instrument_stage(run_log, 'oee', len(df)) as record: # hours before the cut may have new downtime
+        df = add_oee(df, target_rates)
+        record['rows_out'] = len(df)
+
+    # KEEPS WHAT THE NEXT UPDATE NEEDS #
+    cut_hour = round_to_next_hour(RejectData_window['DateTime'].iloc[-1], 0)
+    first_carried = max(int((RejectData_window['DateTime'] >= cut_hour).to_numpy().argmax()) - 1, 0)
+    last_reset = RobotFailure_window['Rst DateTime'].max()
+    if pd.isna(last_reset): # no stoppage yet (e.g. on 1 January) or none with a valid reset time: nothing to carry
+        carry_from = state['carry_from']
+        RobotFailure_carry = RobotFailure_no_duplicates.iloc[:0]
+    else:
+        carry_from = last_reset - datetime.timedelta(hours=incremental_overlap_hours)
+        RobotFailure_carry = RobotFailure_no_duplicates.loc[RobotFailure_no_duplicates['Rst DateTime'] > carry_from]
+    state.update(hourly=df, RejectData_carry=RejectData_window.iloc[first_carried:].reset_index(drop=True),
+                 RobotFailure_carry=RobotFailure_carry.reset_index(drop=True), carry_from=carry_from, cut_hour=cut_hour,
+                 pending_downtime=minutes_per_hour.loc[minutes_per_hour.index >= cut_hour])
+    return df, changed_hours
+
+
+def run_incremental(file_path_RejectData, file_path_RobotFailure, stoppages_lookup, reject_weights, target_rates,
+                    output_path, checkpoint_path, max_new_bytes=None, run_log=None, rollup_prefix=None):
+    '''
+    Incremental (watermark) mode for the RejectData and RobotFailure logs, which grow all year ('F_Y').
+    Reads only the lines appended since the last run, recomputes only the hours they affect and merges
+    them into the existing hourly output (see update_hourly). The checkpoint keeps, per metric, the byte offset
+    read, the last DateTime and the last rows, plus the downtime of the hours that are still going to be recomputed.
+    Without a valid checkpoint it processes the whole logs (same result as a full run) and creates one.
+    arguments: paths of the RejectData and RobotFailure logs, lookup from build_stoppage_lookup,
+    reject weights and target rates (see read_reject_weights and read_target_rates), path of the hourly output, path of the checkpoint and max_new_bytes, to read at most that many new bytes
+    of each log per call (a backfill then runs in bounded memory, calling it until it returns None)
+    optional run log (see instrument_stage) and rollup_prefix, to keep the rollups up to date (see update_rollups).
+    returns: (hourly DataFrame, DateTimes of the changed hours, None when every hour is new; see update_hourly),
+    None when there was nothing new since the last run.
+    '''
+    file_paths = {'RejectData': file_path_RejectData, 'RobotFailure': file_path_RobotFailure}
+    checkpoint = load_checkpoint(checkpoint_path, output_path, file_paths)
+    if checkpoint is None: # starts from the beginning of the files
+        checkpoint = {metric: {'path': file_path, 'offset': 0, 'header': '', 'last_datetime': None, 'carry': None}
+                      for metric, file_path in file_paths.items()}
+        checkpoint['cut_hour'] = None
+        checkpoint['pending_downtime'] = None
+    elif all(os.path.getsize(file_path) == checkpoint[metric]['offset'] for metric, file_path in file_paths.items()):
+        return None # nothing new since last run
+
+    # READS ONLY THE NEW LINES, AFTER THE ROWS CARRIED FROM THE LAST RUN #
+    with instrument_stage(run_log, 'read') as record:
+        RejectData_lines, RejectData_offset, checkpoint['RejectData']['header'] = read_new_lines(
+            file_path_RejectData, checkpoint['RejectData']['offset'], checkpoint['RejectData']['header'], max_new_bytes)
+        RobotFailure_lines, RobotFailure_offset, checkpoint['RobotFailure']['header'] = read_new_lines(
+            file_path_RobotFailure, checkpoint['RobotFailure']['offset'], checkpoint['RobotFailure']['header'],
+            max_new_bytes)
+        RejectData_new, RobotFailure_new = None, None
+        if RejectData_offset > checkpoint['RejectData']['offset']:
+            RejectData_new = read_reject_data(RejectData_lines)
+        if RobotFailure_offset > checkpoint['RobotFailure']['offset']:
+            RobotFailure_new = read_robot_failure(RobotFailure_lines)
+        record['rows_out'] = sum(len(new_rows) for new_rows in [RejectData_new, RobotFailure_new] if new_rows is not None)
+    if RejectData_new is None and RobotFailure_new is None:
+        return None # only an incomplete line was appended
+    if checkpoint['RejectData']['carry'] is None and (RejectData_new is None or len(RejectData_new) == 0):
+        return None # no RejectData row yet (e.g. on 1 January): no hour to recompute, the stoppages are read again later
+
+    state = {'hourly': None, 'RejectData_carry': None, 'RobotFailure_carry': None, 'carry_from': None,
+             'cut_hour': None, 'pending_downtime': None}
+    if checkpoint['RejectData']['carry'] is not None:
+        state['RejectData_carry'] = read_export(io.StringIO(checkpoint['RejectData']['carry']), reject_data_schema)
+    if checkpoint['RobotFailure']['carry'] is not None:
+        state['RobotFailure_carry'] = read_export(io.StringIO(checkpoint['RobotFailure']['carry']),
+                                                  robot_failure_schema)
+    if checkpoint['RobotFailure'].get('carry_from') not in (None, 'NaT'):
+        state['carry_from'] = pd.Timestamp(checkpoint['RobotFailure']['carry_from'])
+    if checkpoint['pending_downtime'] is not None:
+        state['pending_downtime'] = pd.read_csv(io.StringIO(checkpoint['pending_downtime']), index_col=0,
+                                                parse_dates=True)
+    if checkpoint['cut_hour'] is not None:
+        state['cut_hour'] = pd.Timestamp(checkpoint['cut_hour'])
+        state['hourly'] = read_export(output_path, reject_data_schema, index_col=0)
+    df, changed_hours = update_hourly(state, RejectData_new, RobotFailure_new, stoppages_lookup, reject_weights,
+                                      target_rates, run_log)
+    with instrument_stage(run_log, 'export', len(df)) as record:
+        df.to_csv(output_path, na_rep='N/A') #exports to the file folder
+        record['rows_out'] = len(df)
+
+    if rollup_prefix is not None:
+        with instrument_stage(run_log, 'rollup', len(df) if changed_hours is None else len(changed_hours)) as record:
+            rollups = update_rollups(None if changed_hours is None else load_rollups(rollup_prefix), df, changed_hours)
+            save_rollups(rollups, rollup_prefix)
+            record['rows_out'] = sum(len(rollup) for rollup in rollups.values())
+
+    # SAVES THE CHECKPOINT FOR THE NEXT RUN #
+    checkpoint['RejectData'].update(offset=RejectData_offset,
+                                    last_datetime=str(state['RejectData_carry']['DateTime'].iloc[-1]),
+                                    carry=state['RejectData_carry'].to_csv(index=False))
+    carry_from = None if pd.isna(state['carry_from']) else state['carry_from'] # None before the first stoppage
+    checkpoint['RobotFailure'].update(offset=RobotFailure_offset, carry_from=None if carry_from is None else str(carry_from),
+                                      last_datetime=None if carry_from is None else
+                                      str(carry_from + datetime.timedelta(hours=incremental_overlap_hours)),
+                                      carry=state['RobotFailure_carry'].to_csv(index=False))
+    checkpoint['cut_hour'] = str(state['cut_hour'])
+    checkpoint['pending_downtime'] = state['pending_downtime'].to_csv()
+    checkpoint['output_size'] = os.path.getsize(output_path)
+    with open(checkpoint_path + '.tmp', 'w') as file1:
+        json.dump(checkpoint, file1)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+    return df, changed_hours
 
 
 # = = = = = = = = = = = = = = = = = = = = = = #
 # DEFINES FOLDERS STRUCTURES AND ROBOTS NAMES #
 # = = = = = = = = = = = = = = = = = = = = = = #
 
+# SCHEMAS OF THE LOGS: (column in the file, name used in the ETL, type) per column; optional columns may be
+# missing in the file (older robot software) and DateTime columns are converted trying datetime_formats in order.
+# names provided by robots team
+reject_data_reasons = ['Cable Rejects', 'Swager Misses', 'FitCut Misses', 'Lead Rejects', 'Tail Rejects',
+'HypoRejects', 'Stuck Rejects', 'OL Rejects #', 'UZ Rejects', 'FL Rejects', 'Knots', 'ENFORCER!', 'Bad Hypo Insert',
+'FL OL Rejects', 'Cam Faults', 'Ejected Ftgs', 'StakePulls', 'StakePullUnder', 'TailSlideJog', 'TailUnstick',
+'TailSlideJogRejects', 'TailUnstickRejects']
+reject_data_schema = {
+'columns': [('DateTime', 'DateTime', 'datetime'), ('P#', 'Part #', 'category'), ('L#', 'Lot #', 'category'),
+            ('LotCount', 'Lot Count', 'Int32'), ('PartsMade', 'Parts Made', 'Int32')] +
+           [('Reject' + str(i + 1), reason, 'Int32') for i, reason in enumerate(reject_data_reasons)],
+'optional': ['Reject19', 'Reject20', 'Reject21', 'Reject22'],
+'datetime_formats': ['%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M', '%m/%d/%Y']}
+
+robot_failure_schema = {
+'columns': [('Rst DateTime', 'Rst DateTime', 'datetime'), ('Machine#', 'Machine#', 'category'),
+            ('Emp#', 'Emp#', 'category'), ('Major', 'Major', 'category'), ('Minor0', 'Minor0', 'category'),
+            ('Minor1', 'Minor1', 'category'), ('Minor2', 'Minor2', 'category'), ('Minor3', 'Minor3', 'category'),
+            ('Minor4', 'Minor4', 'category'), ('Detail', 'Detail', 'category'), ('Comment', 'Comment', 'category'),
+            ('Part#', 'Part#', 'category'), ('Lot#', 'Lot#', 'category'), ('LotCount', 'LotCount', 'Int32'),
+            ('LPM DateTime', 'LPM DateTime', 'datetime')],
+'optional': [],
+'datetime_formats': ['%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M', '%m/%d/%Y']}
+
 directories = {
 # Y = year, M = month; 
 # F_D = file per day, F_M = file per month, F_Y = file per year 
-'AllToolLives':'YF_M',
-'CableCutTime': 'YMF_D',
-'ExtraEvents': 'YMF_D',
-'FittingLength': 'YMF_D',
-'FtgLocation': 'YMF_D',
-'OverallLength': 'YMF_D',
-'PressInsertHeight': 'YMF_D',
-'RejectData': 'F_Y',
-'RobotFailure': 'F_Y',
-'RobotStoppage': 'YF_M',
-'StartPress': 'YF_M',
-'UncrimpedZone': 'YMF_D'}
+'AllToolLives': {'layout': 'YF_M'},
+'CableCutTime': {'layout': 'YMF_D'},
+'ExtraEvents': {'layout': 'YMF_D'},
+'FittingLength': {'layout': 'YMF_D'},
+'FtgLocation': {'layout': 'YMF_D'},
+'OverallLength': {'layout': 'YMF_D'},
+'PressInsertHeight': {'layout': 'YMF_D'},
+'RejectData': {'layout': 'F_Y', 'schema': reject_data_schema},
+'RobotFailure': {'layout': 'F_Y', 'schema': robot_failure_schema},
+'RobotStoppage': {'layout': 'YF_M'},
+'StartPress': {'layout': 'YF_M'},
+'UncrimpedZone': {'layout': 'YMF_D'}}
+
+# when stoppages overlap, each instant goes to the first Downtime Type listed here (e.g. ['planned']) and,
+# between stoppages of the same or unlisted types, to the one reset first (see drop_repeated_stoppages)
+overlap_precedence = []
+# in incremental mode, stoppages reset in the last hours are kept to be merged with the ones logged in the next run;
+# a stoppage starting before that (e.g. an outage longer than this) is logged, as its overlaps are not merged
+incremental_overlap_hours = 48
+
+# rollups of the hourly table kept up to date at each run: <robot>_rollup_<level>.csv (see update_rollups)
+rollup_levels = ['shift', 'day', 'week', 'month']
+shift_start_hours = [6, 14, 22] # hour each shift starts; a shift belongs to the day it started
+
+# typed copy of the hourly tables of every robot, updated at each run with the changed hours only
+# (see write_hourly_store and read_hourly_store); None disables it
+hourly_store_path = 'hourly_store.sqlite'
+
+# watch mode (see watch_robots): the logs are polled every watch_poll_seconds, the hourly table of the last
+# watch_retention_hours is kept in memory and served as JSON on http://<watch_host>:<watch_port>/hourly
+watch_poll_seconds = 5
+watch_retention_hours = 7 * 24
+watch_host = '127.0.0.1'
+watch_port = 8050
+
+# local cache of the parsed logs (see cached_read)
+parse_cache_folder = 'parse_cache'
+parse_cache_max_bytes = 2 * 1024**3 # least recently used entries are deleted above this size
+parse_cache_version = 1 # increase when the readers change how a log is parsed, so the cached frames are parsed again
+
+# debug table of the stoppages split per hour (see build_manual_check_table), not needed in production:
+# False skips it, True exports <robot>_RobotFailure_manual_check(0)_2022.csv and (start, end) only that window
+manual_check_export = False
+
+# listings of the robots' shares, reused while a folder doesn't change (see build_catalog and read_metrics)
+catalog_cache_path = 'catalog_cache.json'
+share_read_workers = 8 # files read at the same time from the shares
+
+# wall time, CPU time, peak RSS and rows in/out of every stage, one JSON line per stage and run (see instrument_stage)
+run_log_path = 'run_log.jsonl'
+profile_slowest_stage = False # True dumps cProfile and tracemalloc of the slowest stage to <robot>_slowest_stage.*
 
 robots = {
 'RBHA01': ['RBHA01', 'rb-ha-01'],
@@ -143,301 +1475,441 @@ robots = {
 }
 
 
-# = = = = = = = = = = = = = = =#
-# READS ALL FILE(S) TO BE USED #
-# = = = = = = = = = = = = = = =#
-# DEFINING FILE(S) TO BE OPPENED #
+def read_metrics(selected_robot, metrics, start=None, end=None, max_workers=None, use_parse_cache=False):
+    '''
+    Reads every file of the given metrics for a period (e.g. a month of daily files), fetching and parsing them
+    concurrently on a bounded thread pool, as reads from the robot's share are dominated by network latency.
+    The files are found with build_catalog, through the catalog cache in catalog_cache_path.
+    A file that can't be read is logged and left out.
+    arguments: robot key in the robots dictionary, list of metrics (keys of directories), start and end dates
+    of the period (None: no limit), max_workers (default: share_read_workers) and use_parse_cache (see cached_read).
+    returns: dictionary {metric: DataFrame of all its files concatenated in date order}; RejectData and
+    RobotFailure are read with their schema, the other metrics as plain CSV.
+    '''
+    robot_name = robots[selected_robot][0]   # from dictionary of names 
+    robot_folder = robots[selected_robot][1] # from dictionary of names
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    years = None if start is None or end is None else range(start.year, end.year + 1)
+    catalog_cache = load_catalog_cache(catalog_cache_path)
+    file_paths = {}
+    for metric in metrics:
+        catalog = build_catalog(robot_folder, robot_name, metric, years, catalog_cache)
+        # files whose period (year, month or day, from their date) overlaps [start, end]
+        period_end = catalog['date'] + {'F_Y': pd.DateOffset(years=1), 'YF_M': pd.DateOffset(months=1),
+                                        'YMF_D': pd.DateOffset(days=1)}[directories[metric]['layout']]
+        in_period = np.ones(len(catalog), dtype=bool)
+        if start is not None:
+            in_period &= (period_end > start).values
+        if end is not None:
+            in_period &= (catalog['date'] <= end).values
+        file_paths[metric] = catalog.loc[in_period, 'path'].tolist()
+    save_catalog_cache(catalog_cache, catalog_cache_path)
 
-#selected_robot = 'RBHA02' moved line to position 1
-selected_robot = 'RB17'
-robot_name = robots[selected_robot][0]   # from dictionary of names 
-robot_folder = robots[selected_robot][1] # from dictionary of names
+    readers = {'RejectData': read_reject_data, 'RobotFailure': read_robot_failure}
+    frames = {metric: [None] * len(paths) for metric, paths in file_paths.items()}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or share_read_workers) as executor:
+        futures = {executor.submit(read_source, file_path, readers.get(metric, pd.read_csv), use_parse_cache):
+                   (metric, position, file_path)
+                   for metric, paths in file_paths.items() for position, file_path in enumerate(paths)}
+        for future in concurrent.futures.as_completed(futures):
+            metric, position, file_path = futures[future]
+            try:
+                frames[metric][position] = future.result()
+            except Exception as error:
+                with open("log.txt", 'a') as file1: # appends to a log
+                    file1.write("Could not read " + file_path + " at " +
+                                datetime.datetime.now().strftime('%x %X') + ': ' + repr(error) + '\n')
+    return {metric: pd.concat([frame for frame in metric_frames if frame is not None], ignore_index=True)
+            if any(frame is not None for frame in metric_frames) else pd.DataFrame()
+            for metric, metric_frames in frames.items()}
 
-file_path_RejectData = get_input_file_name(robot_folder, robot_name, 'RejectData')
-file_path_RobotFailure = get_input_file_name(robot_folder, robot_name, 'RobotFailure')
-file_path_RobotStoppage = get_input_file_name(robot_folder, robot_name, 'RobotStoppage')
 
-# names provided by robots team
-reject_data_log_columns = ['DateTime','Part #','Lot #','Lot Count','Parts Made','Cable Rejects',
-'Swager Misses','FitCut Misses','Lead Rejects','Tail Rejects','HypoRejects','Stuck Rejects',
-'OL Rejects #','UZ Rejects','FL Rejects','Knots','ENFORCER!','Bad Hypo Insert', 'FL OL Rejects',
-'Cam Faults','Ejected Ftgs', 'StakePulls', 'StakePullUnder', 'TailSlideJog', 'TailUnstick',
-'TailSlideJogRejects', 'TailUnstickRejects']
-RejectData_raw = pd.read_csv(file_path_RejectData, names=reject_data_log_columns, skiprows=1)
-RobotFailure_raw = pd.read_csv(file_path_RobotFailure)
-planned_downtime = pd.read_csv('planned_downtime.csv')
-#RobotStoppage_raw = pd.read_csv(file_path_RobotStoppage)
-
-# convert to DateTime format
-RejectData_raw['DateTime'] = pd.to_datetime(RejectData_raw['DateTime'])
-RobotFailure_raw['Rst DateTime'] = pd.to_datetime(RobotFailure_raw['Rst DateTime'])
-RobotFailure_raw['LPM DateTime'] = pd.to_datetime(RobotFailure_raw['LPM DateTime'])
-#RobotStoppage_raw['DateTime'] = pd.to_datetime(RobotStoppage_raw['DateTime'])
-
-
-# = = = = = = = = = = = = = = = = = #
-# CALCULATES TOTAL REJECTS PER HOUR #
-# = = = = = = = = = = = = = = = = = #
-# weights defined between engineering and design team to capture true bad parts only once. 
-RejectData_raw['Total Rejects'] = RejectData_raw['Cable Rejects'] + RejectData_raw['Swager Misses'] + \
-                                  RejectData_raw['FitCut Misses'] + RejectData_raw['Lead Rejects']*.75 + \
-                                  RejectData_raw['Tail Rejects']*.75 + RejectData_raw['HypoRejects']*.25 + \
-                                  RejectData_raw['Stuck Rejects'] + RejectData_raw['OL Rejects #'] + \
-                                  RejectData_raw['UZ Rejects'] + RejectData_raw['FL Rejects'] + \
-                                  RejectData_raw['Bad Hypo Insert']*.75 + RejectData_raw['FL OL Rejects'] + \
-                                  RejectData_raw['Cam Faults'] + RejectData_raw['Ejected Ftgs']*.25
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
-# LOOKUP TABLE FOR STOPPAGES CLASSIFICATIONS (SCHEDULED DOWNTIME) #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
-# creating a dictionary of tuples in the format "('Major', 'Minor'): ['planned or non-planned']".
-# In the target dataset of stoppages, the columns major and minor will be compared against those tuples
-# to retrieve if that stoppage was planned or non-planned downtime
-stoppages_raw_tuples = [((getattr(row, 'majorStoppageReason'), getattr(row, 'minorStoppageReason')),
-      getattr(row, 'classificationStoppageReason') ) for row in planned_downtime.itertuples(index=False)]
-stoppages=dict()
-for major,minor in stoppages_raw_tuples:
-    stoppages.setdefault(major, []).append(minor)
-
-# CREATING COLUMNS FOR DOWNTIME ## (TODO: change loop to apply function)
-RobotFailure_raw['Downtime Type'] = 0
-for i in range(0,len(RobotFailure_raw)):
-    try: #e.g.: stoppages[('Engineering','Code changes')] returns 'planned'
-        [RobotFailure_raw['Downtime Type'].iloc[i]] = stoppages[(RobotFailure_raw['Major'][i],RobotFailure_raw['Minor0'][i])]
-    except (KeyError):
-        RobotFailure_raw['Downtime Type'].iloc[i] = 'no valid code' # is going to be counted as unplanned
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
-# CLEANS ENTRIES FOR PROCESSING – DELETES REPEATED ROWS & ADJUSTS TIMES FOR SMOOTH TRANSITION #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
-# drops all but the last repeated consecutive rows, when the stoppage starts and 
-# the type of stoppage (planned vs. unplanned) are the same. The sttopage on the last row always ends later
-# hence no data is lost by dropping the previous repeated rows.
-
-for i in range(1,len(RobotFailure_raw)-1):
-    if RobotFailure_raw['LPM DateTime'][i] == RobotFailure_raw['LPM DateTime'][i+1] and \
-    RobotFailure_raw['Downtime Type'][i] == RobotFailure_raw['Downtime Type'][i+1]:
-        RobotFailure_raw.drop(i, axis=0, inplace=True) #drops repeated rows
-RobotFailure_no_duplicates = RobotFailure_raw.reset_index(drop=True) #to avoid jump in index values
-
-# when they start at the same time, replace the new start with the previous stop, so the whole period the robot
-# didn't work will be a continuous interval of stoppages
-# In some cases, there is more than 2 changes in planned/unplanned starting at the same time,
-# which means the 2nd time will copy the 1st one, but by the time the 3rd is checked with the 2nd,
-# the 2nd was already changed and they will be different. This would lead to a smaller LPM date than the previous.
-# a check for <= checks for both cases.
-for i in range(1,len(RobotFailure_no_duplicates)):
-    if RobotFailure_no_duplicates['LPM DateTime'][i] <= RobotFailure_no_duplicates['LPM DateTime'][i-1]:
-        RobotFailure_no_duplicates['LPM DateTime'].iloc[i] = RobotFailure_no_duplicates['Rst DateTime'][i-1]
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =#
-# SPLITS LONG ENTRIES (WHEN OVERFLOWS TO THE NEXT HOUR) INTO TWO #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =#
-# When any interval goes after the hour (e.g. 7:50 to 9:10), split it in two:
-#   * one from the first start to the first whole hour;
-#   * one from the first whole hour to the end.
-# One split is enough, as only one event will cross the hour. Later hours are going to be either 60 minutes
-# or summed with other entries.
-'''
-# 11:50 | 13:50 (original row)
-#       V
-# 11:50 | 12:00 (transforms row)
-# 12:00 | 13:50 (adds row)
-''' 
-RobotFailure_no_duplicates_split = RobotFailure_no_duplicates.copy()
-for i in range(1,len(RobotFailure_no_duplicates_split)): #If starts and ends on the same hour, do nothing.
-    if RobotFailure_no_duplicates_split['LPM DateTime'][i].hour != RobotFailure_no_duplicates_split['Rst DateTime'][i].hour:
-        RobotFailure_no_duplicates_split.loc[i +0.5] = RobotFailure_no_duplicates_split.loc[i] # makes new inter line = previous
-        # starts on first hour after overflow (round_next_hour last LPM), ends on original value (line is already duplicated)
-        RobotFailure_no_duplicates_split.loc[i +0.5, 'LPM DateTime'] = round_to_next_hour(RobotFailure_no_duplicates_split.loc[i, 'LPM DateTime'])
-        # changes row[i] to end on the next rounded hour, so the line [i + 0.5] can start there and go until original end 
-        RobotFailure_no_duplicates_split['Rst DateTime'].iloc[i] = round_to_next_hour(RobotFailure_no_duplicates_split['LPM DateTime'][i])
-RobotFailure_no_duplicates_split = RobotFailure_no_duplicates_split.sort_index().reset_index(drop=True)
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
-# CREATES 2 FAKE EVENTS OF 0 SEC AT THE LAST ROWS FOR MAKING THE RANGE FOR RESAMPLE #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = # 
-#     When resampling, the last value in the df is going to be the final range of the
-# new array. By adding a fake value of 0 seconds, it forces the new array to finish at
-# that hour; as it necessaryly happens after the last real value, it forces the function
-# to count time to be in range.
-#     It needs to be one of each (planned and unplanned downtime) as they'll be split.
-
-
-# duplicates the last row
-RobotFailure_no_duplicates_split = RobotFailure_no_duplicates_split.append(RobotFailure_no_duplicates_split.tail(1), ignore_index=True)
-# changes descriptions to make clear when exporting table that those were created
-RobotFailure_no_duplicates_split.loc[RobotFailure_no_duplicates_split.index[-1], ('Major')] = 'Non Error'
-RobotFailure_no_duplicates_split.loc[RobotFailure_no_duplicates_split.index[-1], ('Minor0')] = 'Placeholder for OEE calculation'
-RobotFailure_no_duplicates_split.loc[RobotFailure_no_duplicates_split.index[-1], ('Minor1')] = 'Placeholder for OEE calculation'
-RobotFailure_no_duplicates_split.loc[RobotFailure_no_duplicates_split.index[-1], ('Comment')] = 'Placeholder for OEE calculation'
-RobotFailure_no_duplicates_split.loc[RobotFailure_no_duplicates_split.index[-1], ('Downtime Type')] = 'planned'
-# copies the value from Rst to LPM, to create a zero seconds event
-RobotFailure_no_duplicates_split.iloc[-1, RobotFailure_no_duplicates_split.columns.get_loc('LPM DateTime')] = \
-    RobotFailure_no_duplicates_split.iloc[-1, RobotFailure_no_duplicates_split.columns.get_loc('Rst DateTime')]
-# repeat the same steps but for non-planned downtime, as the tables will be split to spread the downtime through the hours;
-RobotFailure_no_duplicates_split = RobotFailure_no_duplicates_split.append(RobotFailure_no_duplicates_split.tail(1), ignore_index=True)
-# as the times and descriptions were already changed, only the Downtime Type must be updated
-RobotFailure_no_duplicates_split.loc[RobotFailure_no_duplicates_split.index[-1], ('Downtime Type')] = 'non-planned'
-
-
-# = = = = = = = = = = = = = = = = = = = = = #
-# ADDS COLUMNS FOR DEBBUGING / MANUAL CHECK #
-# = = = = = = = = = = = = = = = = = = = = = #
-
-# adds columns to RobotFailure_raw:
-#    'Minutes down at the hour' is the maximum number of minutes that stoppage could fit inside that hour.
-#       If the the stoppage overflows to the next hour, it is set to '0', hence its maximum value is 59.
-#    'max minutes to be absorbed' is similar to 'Minutes down at the hour', but it is set for all minutes
-#       left, without a maximum.
-#    'remainder left for future hours' is the difference between the total amount of time for that stoppage
-#       and how much it can still be used on that very same hour
-# note that 'max minutes to be absorbed' + 'remainder left for future hours' = total downtime for a given period.
-
-RobotFailure_extra_columns=RobotFailure_no_duplicates_split.copy()
-
-# POPULATE COLUMNS FOR DOWNTIME MEASUREMENT
-RobotFailure_extra_columns['time_per_stop'] = RobotFailure_extra_columns['Rst DateTime'] - RobotFailure_extra_columns['LPM DateTime']
-
-RobotFailure_extra_columns['Minutes down at the hour'] = np.where(
-                                                        RobotFailure_extra_columns['LPM DateTime'].dt.minute + RobotFailure_extra_columns['LPM DateTime'].dt.second/60 +
-                                                        RobotFailure_extra_columns['time_per_stop']/np.timedelta64(1, 'm') >= 60,
-                                                            'overflow',
-#                                                        0, # taking only the minutes doesn't return enought granularity. Taking the decimal from sec
-                                                        (RobotFailure_extra_columns['Rst DateTime'].dt.minute + RobotFailure_extra_columns['Rst DateTime'].dt.second / 60)- 
-                                                        (RobotFailure_extra_columns['LPM DateTime'].dt.minute + RobotFailure_extra_columns['LPM DateTime'].dt.second / 60))
-
-RobotFailure_extra_columns['max minutes to be absorbed'] = np.where(
-                                                        RobotFailure_extra_columns['LPM DateTime'].dt.minute + RobotFailure_extra_columns['LPM DateTime'].dt.second/60 +
-                                                        RobotFailure_extra_columns['time_per_stop']/np.timedelta64(1, 'm') >= 60, #
-                                                        60 - (RobotFailure_extra_columns['LPM DateTime'].dt.minute + RobotFailure_extra_columns['LPM DateTime'].dt.second/60) ,
-                                                        (RobotFailure_extra_columns['Rst DateTime'].dt.minute + RobotFailure_extra_columns['Rst DateTime'].dt.second/60) -
-                                                        (RobotFailure_extra_columns['LPM DateTime'].dt.minute + RobotFailure_extra_columns['LPM DateTime'].dt.second/60))
-
-RobotFailure_extra_columns['remainder left for future hours'] = np.where(
-                                                        RobotFailure_extra_columns['Minutes down at the hour'] != 'overflow',
-#                                                        RobotFailure_extra_columns['Minutes down at the hour'] > 0.0,
-                                                        '0',
-                                                        RobotFailure_extra_columns['time_per_stop']/np.timedelta64(1, 's')/60 -
-                                                        (60-(RobotFailure_extra_columns['LPM DateTime'].dt.minute + RobotFailure_extra_columns['LPM DateTime'].dt.second/60)))
-
-RobotFailure_reordered = RobotFailure_extra_columns.columns.tolist()
-RobotFailure_reordered = RobotFailure_extra_columns[['LPM DateTime', 'Rst DateTime',  'Downtime Type', 'time_per_stop',
-                                            'Minutes down at the hour', 'max minutes to be absorbed',
-                                            'remainder left for future hours', 'Detail', 'Major', 'Minor0', 'Part#', 'Lot#']]
-
-
-
-#RejectData_raw.to_csv(robot_name + '_view_only_RejectData_raw(1).csv')
-RobotFailure_reordered.to_csv(robot_name + '_RobotFailure_manual_check(0)_2022.csv') #exports to the file folder
-#RobotFailure_raw.to_csv(robot_name + '_view_only_RobotFailure_raw.csv')
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =#
-# CALCULATES COLUMNS FOR FUTURE SPREADING THE MINUTES PER HOUR #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =#
-RobotFailure_spread = RobotFailure_no_duplicates_split.copy()
-# adds hour columns to the df so it can be grouped by them. NOTE 'diff_min' = round('max minutes to be absorbed')
-RobotFailure_spread['time_per_stop'] = RobotFailure_spread['Rst DateTime'] - RobotFailure_spread['LPM DateTime']
-RobotFailure_spread['diff_min'] = round(RobotFailure_spread['time_per_stop'].apply(lambda x: x.seconds/60 + x.days*24*60)) #seconds up to a day, days after that
-RobotFailure_spread['DateTime'] = RobotFailure_spread['LPM DateTime'].apply(lambda x: x.floor('H'))
-
-RobotFailure_spread_planned = RobotFailure_spread.loc[RobotFailure_spread['Downtime Type'] == 'planned']
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-#                ROUNDS HOURS IF IN BETWEEN TWO HOURS             #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-RejectData_sum_hour_rounded = RejectData_raw.copy()
-for i in range(1, len(RejectData_sum_hour_rounded.DateTime)-1): # so it can compare with previous and next values
-    # to be changed, that hour must be different than thar rounded hour AND
-    # if i rounded value is bigger than rounded previous but smaller than rounded next
-    # as to avoid 4:05 and 4:06 receiving the same data when merging this df with data
-    if RejectData_sum_hour_rounded['DateTime'].iloc[i] != round_to_next_hour(RejectData_sum_hour_rounded['DateTime'].iloc[i], 0) and \
-                                                          round_to_next_hour(RejectData_sum_hour_rounded['DateTime'].iloc[i-1], 0) < \
-                                                          round_to_next_hour(RejectData_sum_hour_rounded['DateTime'].iloc[i], 0) < \
-                                                          round_to_next_hour(RejectData_sum_hour_rounded['DateTime'].iloc[i+1], 0):
-#        print('rounded hour:' + str(RejectData_sum_hour_rounded['DateTime'].iloc[i]))
-        RejectData_sum_hour_rounded.DateTime.iloc[i] = round_to_next_hour(RejectData_sum_hour_rounded.DateTime[i], 0)
-'''
-RejectData_sum_hour_rounded.to_csv('erase_RejectData_sum_hour_rounded.csv')
-'''
+def resolve_sources(selected_robot, year=None, sources=None):
+    '''
+    Completes the inputs of a robot: the ones not given in sources are its logs on the robot's share
+    (see get_input_file_name) and the config files in the working folder.
+    arguments: robot key in the robots dictionary, year of the logs (None: default of get_input_file_name)
+    and dictionary of the given sources (see run).
+    returns: dictionary with the 'RejectData', 'RobotFailure', 'planned_downtime', 'reject_weights' and 'target_rates' sources.
+    '''
+    robot_name = robots[selected_robot][0]   # from dictionary of names 
+    robot_folder = robots[selected_robot][1] # from dictionary of names
+    year_folder = {} if year is None else {'year_folder': year}
+    resolved = {'RejectData': get_input_file_name(robot_folder, robot_name, 'RejectData', **year_folder),
+                'RobotFailure': get_input_file_name(robot_folder, robot_name, 'RobotFailure', **year_folder),
+                'planned_downtime': 'planned_downtime.csv',
+                'reject_weights': 'reject_weights.csv',
+                'target_rates': 'target_rates.csv'}
+    resolved.update(sources or {})
+    return resolved
+
+
+def read_source(source, reader, use_parse_cache=False):
+    '''
+    Reads one input, given as a path, a file-like object or already loaded (DataFrame / Series).
+    arguments: source, reader for paths and file-like objects (e.g. read_reject_data) and
+    use_parse_cache, to read paths with cached_read.
+    returns: DataFrame or Series; a loaded one is returned as a shallow copy, so the caller's one is not changed.
+    '''
+    if isinstance(source, (pd.DataFrame, pd.Series)):
+        return source.copy(deep=False)
+    if use_parse_cache and isinstance(source, (str, os.PathLike)):
+        return cached_read(source, reader)
+    return reader(source)
+
+
+def read_config(sources):
+    '''
+    Reads the config of the ETL from the sources (see resolve_sources).
+    arguments: dictionary of sources.
+    returns: (stoppages lookup from build_stoppage_lookup, reject weights, target rates).
+    '''
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+    # LOOKUP TABLE FOR STOPPAGES CLASSIFICATIONS (SCHEDULED DOWNTIME) #
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+    # indexes the (major, minor) pairs of planned_downtime.csv, so the columns Major and Minor0 of the
+    # stoppages can be joined against them to retrieve if that stoppage was planned or non-planned downtime
+    stoppages_lookup = build_stoppage_lookup(read_source(sources['planned_downtime'], pd.read_csv))
+    # weights of each reject reason in 'Total Rejects' and target production rate of each part number (OEE)
+    reject_weights = read_source(sources['reject_weights'], read_reject_weights)
+    target_rates = read_source(sources['target_rates'], read_target_rates)
+    return stoppages_lookup, reject_weights, target_rates
+
+
+def run(selected_robot, year=None, sources=None, manual_check=False, use_parse_cache=False, log_path=None,
+        run_log=None):
+    '''
+    Runs the ETL of one robot in memory and returns the results; nothing is written to disk
+    (except the parse cache and the log, when asked for).
+    usage: df, manual_check = run('RB17', 2022, sources={'RobotFailure': RobotFailure_raw}, manual_check=True)
+    arguments: robot key in the robots dictionary, year of the logs (None: default of get_input_file_name),
+    sources, to give any input instead of reading it from the robot's share or the working folder:
+       'RejectData', 'RobotFailure': path, file-like object or DataFrame from read_reject_data / read_robot_failure;
+       'planned_downtime': path, file-like object or DataFrame of planned_downtime.csv;
+       'reject_weights', 'target_rates': path, file-like object or Series from read_reject_weights / read_target_rates;
+    manual_check: True also builds the manual check table, (start, end) builds it only for that window,
+    use_parse_cache for paths (see cached_read), log_path of the stoppages with no valid code (see add_downtime_type)
+    and optional run log (see instrument_stage).
+    returns: (hourly DataFrame, manual check DataFrame from manual_check_table, None unless asked for).
+    '''
+    sources = resolve_sources(selected_robot, year, sources)
+    stoppages_lookup, reject_weights, target_rates = read_config(sources)
+
+    # = = = = = = = = = = = = = = =#
+    # READS ALL FILE(S) TO BE USED #
+    # = = = = = = = = = = = = = = =#
+    # unchanged files are loaded from the local parse cache
+    # both logs are fetched at the same time (reads from the share are dominated by network latency)
+    with instrument_stage(run_log, 'read') as record:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            RejectData_future = executor.submit(read_source, sources['RejectData'], read_reject_data, use_parse_cache)
+            RobotFailure_future = executor.submit(read_source, sources['RobotFailure'], read_robot_failure,
+                                                  use_parse_cache)
+            RejectData_raw, RobotFailure_raw = RejectData_future.result(), RobotFailure_future.result()
+        record['rows_out'] = len(RejectData_raw) + len(RobotFailure_raw)
+    #RobotStoppage_raw = pd.read_csv(file_path_RobotStoppage)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =#
+    # CLASSIFIES STOPPAGES, DELETES REPEATED ROWS AND ALLOCATES THE DOWNTIME PER HOUR #
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =#
+    RobotFailure_no_duplicates, downtime_per_hour = process_stoppages(RobotFailure_raw, stoppages_lookup, run_log,
+                                                                      log_path)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+    # ADDS COLUMNS FOR DEBBUGING / MANUAL CHECK, ONLY WHEN ASKED FOR #
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+    RobotFailure_reordered = None
+    if manual_check: # True or a (start, end) window
+        window = (None, None) if manual_check is True else manual_check
+        with instrument_stage(run_log, 'split', len(RobotFailure_no_duplicates)) as record:
+            RobotFailure_reordered = manual_check_table(RobotFailure_no_duplicates, *window)
+            record['rows_out'] = len(RobotFailure_reordered)
+
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+    # MERGES REJECTDATA WITH THE PLANNED AND UNPLANNED DOWNTIMES, FILLS THE MISSING HOURS #
+    # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+    df = build_hourly_table(RejectData_raw, downtime_minutes_per_hour(downtime_per_hour), reject_weights,
+                            run_log=run_log)
+    with instrument_stage(run_log, 'oee', len(df)) as record:
+        df = add_oee(df, target_rates)
+        record['rows_out'] = len(df)
+    return df, RobotFailure_reordered
+
+
+def run_robot(selected_robot, incremental=False, chunk_bytes=None):
+    '''
+    Runs the ETL for one robot: reads its logs, builds the hourly table and exports it to the file folder
+    and to the hourly store (see write_hourly_store).
+    Every stage is timed and appended to run_log_path (see instrument_stage), also when the run fails.
+    arguments: robot key in the robots dictionary; incremental=True only processes what was appended
+    to the logs since the last run (see run_incremental), chunk_bytes of each log at a time if given.
+    returns: hourly DataFrame.
+    '''
+    # DEFINING FILE(S) TO BE OPPENED #
+    robot_name = robots[selected_robot][0] # from dictionary of names 
+    sources = resolve_sources(selected_robot)
+    output_path = robot_name + '_complete_final_trial(2)_2022.csv'
+
+    run_log = start_run_log(robot_name, profile_slowest_stage)
+    try:
+        if incremental:
+            stoppages_lookup, reject_weights, target_rates = read_config(sources)
+            # with chunk_bytes, a backfill (e.g. first run on a year of logs) is processed in bounded memory
+            df, changed_hours = None, pd.DatetimeIndex([])
+            while True:
+                result = run_incremental(sources['RejectData'], sources['RobotFailure'], stoppages_lookup,
+                                         reject_weights, target_rates, output_path, robot_name + '_checkpoint.json',
+                                         chunk_bytes, run_log, robot_name)
+                if result is None:
+                    break
+                df, chunk_changed_hours = result
+                changed_hours = None if chunk_changed_hours is None or changed_hours is None else \
+                                changed_hours.union(chunk_changed_hours)
+            # nothing new since last run: the output and the store are up to date
+            if df is None and os.path.exists(output_path):
+                return read_export(output_path, reject_data_schema, index_col=0)
+        if df is None: # full run; also in incremental mode before the first RejectData row (empty output)
+            changed_hours = None # every hour
+            df, RobotFailure_reordered = run(selected_robot, sources=sources, manual_check=manual_check_export,
+                                             use_parse_cache=True, log_path="log.txt", run_log=run_log)
+            with instrument_stage(run_log, 'export', len(df)) as record:
+                #RejectData_raw.to_csv(robot_name + '_view_only_RejectData_raw(1).csv')
+                if RobotFailure_reordered is not None: # only when debugging (see manual_check_export)
+                    RobotFailure_reordered.to_csv(robot_name + '_RobotFailure_manual_check(0)_2022.csv', na_rep='N/A')
+                df.to_csv(output_path, na_rep='N/A') #exports to the file folder
+                record['rows_out'] = len(df)
+
+            # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+            # ROLLUPS PER SHIFT, DAY, WEEK AND MONTH (<robot>_rollup_<level>.csv) #
+            # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+            with instrument_stage(run_log, 'rollup', len(df)) as record:
+                rollups = update_rollups(None, df)
+                save_rollups(rollups, robot_name)
+                record['rows_out'] = sum(len(rollup) for rollup in rollups.values())
+
+        # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+        # HOURLY STORE (SQLITE): ONLY THE HOURS THAT CHANGED SINCE THE LAST RUN ARE WRITTEN #
+        # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = #
+        if hourly_store_path is not None:
+            with instrument_stage(run_log, 'store', len(df) if changed_hours is None else len(changed_hours)) as record:
+                record['rows_out'] = write_hourly_store(df, robot_name, hourly_store_path, changed_hours)
+
+        #df.hour = df.date.dt.strftime('%H:%M:%S')
+        #df.date = df.date.dt.strftime('%d-%m-%Y')
+        return df
+    finally:
+        write_run_log(run_log, run_log_path, robot_name)
+
+
+def run_robots(selected_robots, incremental=False, max_workers=None, chunk_bytes=None):
+    '''
+    Runs the ETL of several robots in parallel, one process per robot (up to max_workers at a time).
+    A robot that fails is logged and left out, without stopping the others.
+    arguments: list of robot keys in the robots dictionary, incremental and chunk_bytes (see run_robot) and
+    max_workers (None uses the number of cores).
+    returns: combined hourly DataFrame, with a 'Robot' column.
+    '''
+    hourly_tables = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_robot, selected_robot, incremental, chunk_bytes): selected_robot
+                   for selected_robot in selected_robots}
+        for future in concurrent.futures.as_completed(futures):
+            selected_robot = futures[future]
+            try:
+                df = future.result()
+            except Exception as error:
+                print('ETL failed for ' + selected_robot + ': ' + repr(error))
+                with open("log.txt", 'a') as file1: # appends to a log
+                    file1.write("ETL failed for " + selected_robot + " at " +
+                                datetime.datetime.now().strftime('%x %X') + ': ' + repr(error) + '\n')
+                continue
+            df.insert(0, 'Robot', robots[selected_robot][0])
+            hourly_tables.append(df)
+    if len(hourly_tables) == 0:
+        return pd.DataFrame(columns=['Robot', 'DateTime'])
+    return pd.concat(hourly_tables, ignore_index=True).sort_values(['Robot', 'DateTime'], kind='stable',
+                                                                   ignore_index=True)
+
+
+def start_watch_state(sources):
+    '''
+    State of one robot in watch mode: what was read from its logs and the state of update_hourly.
+    arguments: dictionary of sources from resolve_sources.
+    returns: dictionary.
+    '''
+    return {'paths': {metric: sources[metric] for metric in ['RejectData', 'RobotFailure']},
+            'offsets': {'RejectData': 0, 'RobotFailure': 0}, 'headers': {'RejectData': '', 'RobotFailure': ''},
+            'hourly_state': {'hourly': None, 'RejectData_carry': None, 'RobotFailure_carry': None, 'carry_from': None,
+                             'cut_hour': None, 'pending_downtime': None},
+            'updated_at': None, 'error': None}
+
+
+def poll_robot(watch_state, selected_robot, config, retention_hours=None, chunk_bytes=None):
+    '''
+    Applies what was appended to the RejectData and RobotFailure logs of a robot since the last poll to its
+    hourly table in memory (see update_hourly) and keeps only the hours of the retention window.
+    The paths are resolved again at every poll (see get_input_file_name): when they change (e.g. a new year)
+    or a log gets smaller (rotated or rewritten), the robot starts over from the beginning of its logs.
+    arguments: state from start_watch_state (updated in place), robot key in the robots dictionary,
+    (stoppages lookup, reject weights, target rates) from read_config, retention_hours (default: watch_retention_hours)
+    and chunk_bytes, to read at most that many new bytes of each log at a time (bounded memory on the first poll).
+    returns: DateTimes of the changed hours (None when every hour changed, empty when nothing was appended).
+    '''
+    retention_hours = watch_retention_hours if retention_hours is None else retention_hours
+    robot_name = robots[selected_robot][0]
+    sources = resolve_sources(selected_robot)
+    sizes = {metric: os.path.getsize(sources[metric]) for metric in ['RejectData', 'RobotFailure']}
+    if any(sources[metric] != file_path or sizes[metric] < watch_state['offsets'][metric]
+           for metric, file_path in watch_state['paths'].items()):
+        watch_state.update(start_watch_state(sources))
+    all_changed_hours = pd.DatetimeIndex([])
+    while any(sizes[metric] > watch_state['offsets'][metric] for metric in sizes):
+        run_log = start_run_log(robot_name)
+        try:
+            with instrument_stage(run_log, 'read') as record:
+                new_rows, offsets = {}, {}
+                for metric, reader in [('RejectData', read_reject_data), ('RobotFailure', read_robot_failure)]:
+                    lines, offsets[metric], watch_state['headers'][metric] = read_new_lines(
+                        sources[metric], watch_state['offsets'][metric], watch_state['headers'][metric], chunk_bytes)
+                    new_rows[metric] = reader(lines) if offsets[metric] > watch_state['offsets'][metric] else None
+                record['rows_out'] = sum(len(rows) for rows in new_rows.values() if rows is not None)
+            if record['rows_out'] == 0:
+                watch_state['offsets'].update(offsets)
+                break # only an incomplete line (or the header) was appended
+            if watch_state['hourly_state']['RejectData_carry'] is None and \
+               (new_rows['RejectData'] is None or len(new_rows['RejectData']) == 0):
+                break # no RejectData row yet: no hour to recompute, the stoppages are read again at the next poll
+            df, changed_hours = update_hourly(watch_state['hourly_state'], new_rows['RejectData'],
+                                              new_rows['RobotFailure'], *config, run_log)
+            # the offsets only move once the rows are applied, so rows that failed are read again at the next poll
+            watch_state['offsets'].update(offsets)
+            # hours before the retention window are dropped (the rows still needed are carried by update_hourly)
+            df = df.loc[df['DateTime'] > df['DateTime'].max() - datetime.timedelta(hours=retention_hours)]
+            watch_state['hourly_state']['hourly'] = df.reset_index(drop=True)
+            if hourly_store_path is not None:
+                with instrument_stage(run_log, 'store', len(df) if changed_hours is None else len(changed_hours)) as record:
+                    record['rows_out'] = write_hourly_store(df, robot_name, hourly_store_path, changed_hours)
+        finally:
+            write_run_log(run_log, run_log_path)
+        all_changed_hours = None if changed_hours is None or all_changed_hours is None else \
+                            all_changed_hours.union(changed_hours)
+        watch_state['updated_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    return all_changed_hours
+
+
+def hourly_app(watch_states):
+    '''
+    WSGI application serving the hourly tables of the watch mode:
+       GET /hourly?robot=RB17&start=2022-12-01&end=2022-12-02: hourly rows as a JSON list (every robot and
+       hour in memory by default; from start included to end excluded);
+       GET /status: last update, number of hours in memory and last error of each robot.
+    arguments: dictionary {robot name: state from start_watch_state}, updated by the polling loop.
+    returns: WSGI application (function).
+    '''
+    def app(environ, start_response):
+        query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+        path = environ.get('PATH_INFO', '')
+        status, body = '200 OK', None
+        if path == '/status':
+            body = json.dumps({robot_name: {'updated_at': watch_state['updated_at'], 'error': watch_state['error'],
+                                            'hours': 0 if watch_state['hourly_state']['hourly'] is None else
+                                            len(watch_state['hourly_state']['hourly'])}
+                               for robot_name, watch_state in watch_states.items()})
+        elif path == '/hourly':
+            try:
+                selected = query.get('robot', list(watch_states))
+                start = pd.Timestamp(query['start'][0]) if 'start' in query else None
+                end = pd.Timestamp(query['end'][0]) if 'end' in query else None
+            except ValueError as error:
+                status, body = '400 Bad Request', json.dumps({'error': str(error)})
+            else:
+                hourly_tables = []
+                for robot_name in selected:
+                    # the polling loop replaces the table instead of changing it, so this one stays consistent
+                    df = watch_states[robot_name]['hourly_state']['hourly'] if robot_name in watch_states else None
+                    if df is None:
+                        continue
+                    in_range = np.ones(len(df), dtype=bool)
+                    if start is not None:
+                        in_range &= (df['DateTime'] >= start).to_numpy()
+                    if end is not None:
+                        in_range &= (df['DateTime'] < end).to_numpy()
+                    hourly_tables.append(df.loc[in_range].assign(Robot=robot_name))
+                if len(hourly_tables) == 0:
+                    body = '[]'
+                else:
+                    df = pd.concat(hourly_tables, ignore_index=True)
+                    body = df[['Robot'] + list(df.columns.drop('Robot'))].to_json(orient='records', date_format='iso')
+        else:
+            status, body = '404 Not Found', json.dumps({'error': 'use /hourly or /status'})
+        body = body.encode()
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+    return app
+
+
+def watch_robots(selected_robots, poll_seconds=None, retention_hours=None, host=None, port=None, chunk_bytes=None,
+                 max_polls=None):
+    '''
+    Watch mode: keeps the hourly tables of the robots in memory, polling their logs and recomputing only the
+    hours affected by the appended rows (see poll_robot), and serves them on a local HTTP/JSON endpoint
+    (see hourly_app). A robot that fails (e.g. share not reachable) is logged and polled again next time.
+    arguments: list of robot keys in the robots dictionary, poll_seconds, retention_hours, host and port
+    (defaults: watch_poll_seconds, watch_retention_hours, watch_host and watch_port), chunk_bytes (see poll_robot)
+    and max_polls (None: until interrupted).
+    returns: dictionary {robot name: state from start_watch_state}.
+    '''
+    poll_seconds = watch_poll_seconds if poll_seconds is None else poll_seconds
+    sources = {selected_robot: resolve_sources(selected_robot) for selected_robot in selected_robots}
+    configs = {selected_robot: read_config(sources[selected_robot]) for selected_robot in selected_robots}
+    watch_states = {robots[selected_robot][0]: start_watch_state(sources[selected_robot])
+                    for selected_robot in selected_robots}
+    server = wsgiref.simple_server.make_server(watch_host if host is None else host,
+                                               watch_port if port is None else port, hourly_app(watch_states))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            poll_start = time.monotonic()
+            for selected_robot in selected_robots:
+                watch_state = watch_states[robots[selected_robot][0]]
+                try:
+                    poll_robot(watch_state, selected_robot, configs[selected_robot], retention_hours, chunk_bytes)
+                    watch_state['error'] = None
+                except Exception as error:
+                    if watch_state['error'] != repr(error): # logs once, not at every poll
+                        with open("log.txt", 'a') as file1: # appends to a log
+                            file1.write("Watch failed for " + selected_robot + " at " +
+                                        datetime.datetime.now().strftime('%x %X') + ': ' + repr(error) + '\n')
+                    watch_state['error'] = repr(error)
+            polls += 1
+            if max_polls is None or polls < max_polls:
+                time.sleep(max(0, poll_seconds - (time.monotonic() - poll_start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+    return watch_states
+
+
+if __name__ == '__main__':
+    selected_robots = ['RB17'] # e.g. list(robots) runs all robots, in parallel
+    # incremental mode only reads what was appended to the logs since the last run (see run_incremental)
+    incremental = False
+    chunk_bytes = None # in incremental and watch modes, reads at most this many new bytes of each log at a time
+    max_workers = None # number of robots processed at the same time; None uses the number of cores
+    # watch mode keeps running, updating the hourly tables as the logs grow and serving them (see watch_robots)
+    watch = False
+
+    if watch:
+        watch_robots(selected_robots, chunk_bytes=chunk_bytes)
+    elif len(selected_robots) == 1:
+        run_robot(selected_robots[0], incremental, chunk_bytes)
+    else:
+        df_robots = run_robots(selected_robots, incremental, max_workers, chunk_bytes)
+        df_robots.to_csv('all_robots_complete_final_trial(2)_2022.csv', na_rep='N/A') #exports to the file folder
 
-# TODO change next 2 sections in a function and re-use it, as they're equal.
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# SPREAD THE HOURS FOR ALL EVENTS AND RETRIEVE TOTAL DOWNTIME #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-try:
-    # transforms the df in series and groups it by hour
-    sum_minutes_per_hour = RobotFailure_spread[['DateTime', 'diff_min']].groupby(['DateTime']).sum()
-    list_shift_corrected = sum_minutes_per_hour['diff_min'].resample('H').sum() #transforms df in series
-    list_shift_corrected.index = list_shift_corrected.index+datetime.timedelta(hours=1) # shifts index by one to match other files
-    # uses custom function to spread the minutes across the next hours if they overflow
-    spread_minutes_per_hour = expand_per_hours(list_shift_corrected) 
-    # converts back to DataFrame so it can be merged with the RejectData_raw table 
-    minutes_per_hour = pd.DataFrame(spread_minutes_per_hour, columns=['total_down_minutes'])
-    minutes_per_hour.index = list_shift_corrected.axes
-    RejectData_sum_hour_rounded = RejectData_sum_hour_rounded.merge(minutes_per_hour.reset_index(), on=['DateTime', 'DateTime'], how='left')
-except IndexError:
-    print('expand_per_hours failed when calculating total_down_minutes')
-    
-    with open("log.txt", 'a') as file1: # appends to a log
-        file1.write("expand_per_hours failed when calculating total_down_minutes at " + datetime.datetime.now().strftime('%x %X'))
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# SPREAD THE HOURS FOR PLANNED EVENTS AND RETRIEVE PLANNED DOWNTIME #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-
-# transforms the df in series and groups it by hour
-try:
-    sum_minutes_per_hour = RobotFailure_spread_planned[['DateTime', 'diff_min']].groupby(['DateTime']).sum()
-    list_shift_corrected = sum_minutes_per_hour['diff_min'].resample('H').sum() #transforms df in series
-    list_shift_corrected.index = list_shift_corrected.index+datetime.timedelta(hours=1) # shifts index by one to match other files
-    # uses custom function to spread the minutes across the next hours if they overflow
-    spread_minutes_per_hour = expand_per_hours(list_shift_corrected) 
-    # converts back to DataFrame so it can be merged with the RejectData_raw table 
-    minutes_per_hour = pd.DataFrame(spread_minutes_per_hour, columns=['total_planned_minutes'])
-    minutes_per_hour.index = list_shift_corrected.axes
-except IndexError:
-    print('expand_per_hours failed when calculating total_down_minutes')
     with open("log.txt", 'a') as file1: # appends to a log
-        file1.write("expand_per_hours failed when calculating total_down_minutes at " + datetime.datetime.now().strftime('%x %X'))
-
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# MERGES THE PLANNED AND UNPLANNED DOWNTIMES TABLES AND EXPORT IT #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# merges RejectData, total downtime, and planned downtime. Unplanned downtime is the difference between total and planned.
-# making the difference instead of a sum ensures there will be no instance of more than 60 minutes stopped per hour.
-# fills NaN with 0s to avoid the blanks in the end of the columns.
-
-# TODO extracting the time of RejectData gives the most updated time; use it on expand_per_hours to return already the
-# # right size vector and avoid having blanks at the end of the columns. 
-RejectData_sum_hour = RejectData_sum_hour_rounded.merge(minutes_per_hour.reset_index(), on=['DateTime', 'DateTime'], how='left')
-RejectData_sum_hour['total_planned_minutes']=RejectData_sum_hour['total_planned_minutes'].fillna(0)
-RejectData_sum_hour['total_down_minutes']=RejectData_sum_hour['total_down_minutes'].fillna(0)
-RejectData_sum_hour['total_unplanned_minutes'] = RejectData_sum_hour['total_down_minutes'] - RejectData_sum_hour['total_planned_minutes']
-RejectData_sum_hour['total_unplanned_minutes']=RejectData_sum_hour['total_unplanned_minutes'].fillna(0)
-#RejectData_sum_hour.to_csv(robot_name + '_RejectData_sum_per_hour(1).csv') #exports to the file folder
-
-# https://stackoverflow.com/questions/19913659/pandas-conditional-creation-of-a-series-dataframe-column
-
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-#                   FILLS THE MISSING HOURS WITH NAs              #
-# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
-# creates a temporary df with the range of the original one to later merge it with original
-df = pd.DataFrame(pd.date_range(round_to_next_hour(RejectData_sum_hour['DateTime'].min()),\
-        round_to_next_hour(RejectData_sum_hour['DateTime'].max(),0),freq='H'),columns= ['DateTime'])\
-            .merge(RejectData_sum_hour,on=['DateTime'],how='outer').fillna('N/A')
-df.drop(df.tail(1).index,inplace=True) # as last row doesn't contain relevant data
-df.to_csv(robot_name + '_complete_final_trial(2)_2022.csv') #exports to the file folder
-
-#df.hour = df.date.dt.strftime('%H:%M:%S')
-#df.date = df.date.dt.strftime('%d-%m-%Y')
-
-
-with open("log.txt", 'a') as file1: # appends to a log
-    file1.write("Scrip finished running at " + datetime.datetime.now().strftime('%x %X') + '\n')
\ No newline at end of file
+        file1.write("Scrip finished running at " + datetime.datetime.now().strftime('%x %X') + '\n')
@@ -0,0 +1,155 @@
+# Benchmark of the ETL stages on synthetic robot logs.
+'''
+Generates synthetic logs (see generate_robot_logs.py) for each data size and times every stage of the ETL:
+ingest, classification, dedup, hour split, spread, merge, oee and export. Each stage records its wall time,
+peak memory (tracemalloc, i.e. allocated by Python and numpy during the stage) and rows in/out.
+Results are appended as JSON lines, one per stage and size, tagged with the git commit, so regressions
+show up when comparing two runs (--baseline flags stages slower than the baseline by more than --tolerance).
+
+usage: python benchmark_etl.py --sizes 1000,10000 --output benchmark_results.jsonl
+'''
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ETL_robot_data as etl
+import generate_robot_logs
+
+package_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def git_commit():
+    '''
+    returns: short hash of the current commit, or None outside of a git repository.
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=package_folder, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed_stage(stage, function, rows_in, records, trace_memory=True):
+    '''
+    Runs one stage, appending its measurements to records.
+    arguments: stage name, function without arguments, rows_in, list of records and trace_memory
+    (tracemalloc slows down the pure Python loops; False only measures time).
+    returns: what the function returns.
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    wall_start = time.perf_counter()
+    result = function()
+    wall_seconds = time.perf_counter() - wall_start
+    peak_bytes = None
+    if trace_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    rows_out = len(result[0] if isinstance(result, tuple) else result) if result is not None else None
+    records.append({'stage': stage, 'wall_seconds': wall_seconds, 'peak_bytes': peak_bytes,
+                    'rows_in': rows_in, 'rows_out': rows_out})
+    return result
+
+
+def benchmark_size(stoppages, folder, planned_downtime_path, trace_memory=True, seed=0, **kwargs):
+    '''
+    Generates the logs for one data size and runs every ETL stage on them.
+    arguments: number of stoppages (3 hours of RejectData per stoppage), folder for the logs and the output,
+    path of planned_downtime.csv, trace_memory (see timed_stage), seed and arguments of generate_robot_failure.
+    returns: list of records, one per stage.
+    '''
+    file_path_RejectData, file_path_RobotFailure = generate_robot_logs.write_robot_logs(
+        folder, stoppages, planned_downtime_path=planned_downtime_path, with_seconds=True, seed=seed, **kwargs)
+    stoppages_lookup = etl.build_stoppage_lookup(pd.read_csv(planned_downtime_path))
+    reject_weights = etl.read_reject_weights(os.path.join(package_folder, 'reject_weights.csv'))
+    target_rates = etl.read_target_rates(os.path.join(package_folder, 'target_rates.csv'))
+    records = []
+
+    def ingest():
+        return etl.read_reject_data(file_path_RejectData), etl.read_robot_failure(file_path_RobotFailure)
+    RejectData_raw, RobotFailure_raw = timed_stage('ingest', ingest, None, records, trace_memory)
+    records[-1]['rows_out'] = len(RejectData_raw) + len(RobotFailure_raw)
+    RobotFailure_raw = RobotFailure_raw.reset_index(drop=True)
+    RobotFailure_raw = timed_stage('classification', lambda: etl.add_downtime_type(RobotFailure_raw, stoppages_lookup),
+                                   len(RobotFailure_raw), records, trace_memory)
+    RobotFailure_no_duplicates = timed_stage('dedup', lambda: etl.drop_repeated_stoppages(RobotFailure_raw),
+                                             len(RobotFailure_raw), records, trace_memory)
+    timed_stage('hour split', lambda: etl.split_stoppages_on_hours(RobotFailure_no_duplicates),
+                len(RobotFailure_no_duplicates), records, trace_memory)
+    minutes_per_hour = timed_stage('spread', lambda: etl.downtime_minutes_per_hour(etl.allocate_downtime_per_hour(
+                                       RobotFailure_no_duplicates['LPM DateTime'], RobotFailure_no_duplicates['Rst DateTime'],
+                                       RobotFailure_no_duplicates['Downtime Type'])),
+                                   len(RobotFailure_no_duplicates), records, trace_memory)
+    df = timed_stage('merge', lambda: etl.build_hourly_table(RejectData_raw, minutes_per_hour, reject_weights),
+                     len(RejectData_raw), records, trace_memory)
+    df = timed_stage('oee', lambda: etl.add_oee(df, target_rates), len(df), records, trace_memory)
+    output_path = os.path.join(folder, 'benchmark_output.csv')
+    timed_stage('export', lambda: df.to_csv(output_path, na_rep='N/A'), len(df), records, trace_memory)
+    records[-1]['rows_out'] = len(df)
+    return records
+
+
+def find_regressions(records, baseline_path, tolerance):
+    '''
+    Compares the wall time of each (stoppages, stage) with the last run of the same pair in a baseline file.
+    arguments: records of this run, path of a previous results file and tolerance (0.2 = 20% slower).
+    returns: list of messages, one per regression.
+    '''
+    baseline = {}
+    with open(baseline_path) as baseline_file:
+        for line in baseline_file:
+            if line.strip():
+                record = json.loads(line)
+                baseline[(record['stoppages'], record['stage'])] = record['wall_seconds']
+    regressions = []
+    for record in records:
+        previous = baseline.get((record['stoppages'], record['stage']))
+        if previous is not None and record['wall_seconds'] > previous * (1 + tolerance):
+            regressions.append('{stage} ({stoppages} stoppages): {wall_seconds:.4f}s'.format(**record) +
+                               ' vs {:.4f}s in baseline'.format(previous))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks each ETL stage on synthetic logs.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated numbers of stoppages')
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    parser.add_argument('--folder', default=None, help='where the logs are generated (default: temporary folder)')
+    parser.add_argument('--planned-downtime', default=os.path.join(package_folder, 'planned_downtime.csv'))
+    parser.add_argument('--no-memory', action='store_true', help='only measures time (no tracemalloc overhead)')
+    parser.add_argument('--baseline', default=None, help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run_info = {'run_at': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+                'python': sys.version.split()[0], 'pandas': pd.__version__}
+    all_records = []
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        for stoppages in [int(size) for size in args.sizes.split(',')]:
+            folder = os.path.join(args.folder or temporary_folder, str(stoppages))
+            for record in benchmark_size(stoppages, folder, args.planned_downtime, not args.no_memory, args.seed):
+                record = dict(run_info, stoppages=stoppages, **record)
+                all_records.append(record)
+                print('{stoppages:>9} {stage:<15} {wall_seconds:10.4f}s'.format(**record) +
+                      ('' if record['peak_bytes'] is None else '{:10.1f} MB'.format(record['peak_bytes'] / 1024**2)))
+
+    with open(args.output, 'a') as output_file:
+        for record in all_records:
+            output_file.write(json.dumps(record) + '\n')
+
+    if args.baseline is not None:
+        regressions = find_regressions(all_records, args.baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
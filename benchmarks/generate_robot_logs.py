@@ -0,0 +1,157 @@
+# Synthetic robot logs for testing and benchmarking the ETL.
+'''
+Generates RejectDataLog and RobotFailureLog files in the same format as the robots
+(see examples/): one RejectData row per hour and RobotFailure stoppages with a
+configurable number of rows, stop-length distribution, overlapping stops,
+stops starting at the same time (e.g. planned/unplanned change) and multi-hour outages.
+
+usage: python generate_robot_logs.py --stoppages 10000 --folder synthetic
+'''
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# same headers as the files written by the robots
+reject_data_header = ['DateTime', 'P#', 'L#', 'LotCount', 'PartsMade'] + ['Reject' + str(i) for i in range(1, 19)]
+robot_failure_header = ['Rst DateTime', 'Machine#', 'Emp#', 'Major', 'Minor0', 'Minor1', 'Minor2', 'Minor3',
+                        'Minor4', 'Detail', 'Comment', 'Part#', 'Lot#', 'LotCount', 'LPM DateTime']
+comments = ['light curtain', 'light tripped', 'light curtain tripped', 'hypotube slide not fully extended',
+            'NULL', 'cable jam', 'changed spool']
+
+
+def format_robot_datetime(values, with_seconds=False):
+    '''
+    Formats DateTimes as the robots do, e.g. 12/1/2022 0:46 (no leading zeros on month, day and hour).
+    arguments: series of DateTime; with_seconds adds :SS.
+    returns: series of strings.
+    '''
+    formatted = (values.dt.month.astype(str) + '/' + values.dt.day.astype(str) + '/' + values.dt.year.astype(str) +
+                 ' ' + values.dt.hour.astype(str) + ':' + values.dt.minute.astype(str).str.zfill(2))
+    if with_seconds:
+        formatted = formatted + ':' + values.dt.second.astype(str).str.zfill(2)
+    return formatted
+
+
+def generate_reject_data(start, hours, robot_name='RB17', with_seconds=False, seed=0):
+    '''
+    Generates a RejectData log: one row per hour, written a few minutes after the hour.
+    arguments: first DateTime, number of hours, robot name, with_seconds (see format_robot_datetime) and seed.
+    returns: DataFrame with the RejectData header.
+    '''
+    rng = np.random.default_rng(seed)
+    logged_at = pd.Series(pd.date_range(start, periods=hours, freq='H') +
+                          pd.to_timedelta(rng.integers(0, 300, hours), unit='s'))
+    parts_made = rng.poisson(150, hours)
+    RejectData = pd.DataFrame({'DateTime': format_robot_datetime(logged_at, with_seconds),
+                               'P#': 123456, 'L#': 'lotno', 'LotCount': np.cumsum(parts_made) % 10000,
+                               'PartsMade': parts_made})
+    reject_rates = rng.uniform(0, 0.05, 18)
+    reject_rates[11] = 0.3 # Knots-like column, as in the examples
+    for i in range(18):
+        RejectData['Reject' + str(i + 1)] = rng.binomial(parts_made, reject_rates[i])
+    return RejectData[reject_data_header]
+
+
+def generate_robot_failure(start, hours, stoppages, robot_name='RB17', planned_downtime=None,
+                           mean_stop_seconds=600, stop_distribution='exponential', overlap_fraction=0.05,
+                           same_start_fraction=0.05, outage_fraction=0.01, max_outage_hours=30,
+                           unknown_code_fraction=0.3, with_seconds=False, seed=0):
+    '''
+    Generates a RobotFailure log, ordered by reset time (when the robot writes the row).
+    arguments: first DateTime, number of hours, number of stoppages, robot name,
+    planned_downtime table (major/minor codes used; None uses only unknown codes),
+    mean_stop_seconds and stop_distribution ('exponential' or 'lognormal') of the stop lengths,
+    overlap_fraction of stops starting before the previous one ended,
+    same_start_fraction of stops starting at the same time as the previous one,
+    outage_fraction of multi-hour outages (1 to max_outage_hours long),
+    unknown_code_fraction of stops with a code missing in planned_downtime, with_seconds and seed.
+    returns: DataFrame with the RobotFailure header.
+    '''
+    rng = np.random.default_rng(seed)
+    span_seconds = hours * 3600
+    lpm = np.sort(rng.integers(0, span_seconds, stoppages)).astype(np.int64)
+    if stop_distribution == 'lognormal':
+        duration = rng.lognormal(np.log(mean_stop_seconds) - 0.5, 1.0, stoppages)
+    else:
+        duration = rng.exponential(mean_stop_seconds, stoppages)
+    duration = duration.astype(np.int64) + 1
+    outages = rng.random(stoppages) < outage_fraction
+    duration[outages] = rng.integers(3600, max_outage_hours * 3600 + 1, outages.sum())
+    # overlapping stops start inside the previous stop; same-start stops copy its start
+    overlaps = np.flatnonzero(rng.random(stoppages) < overlap_fraction)
+    overlaps = overlaps[overlaps > 0]
+    lpm[overlaps] = lpm[overlaps - 1] + (duration[overlaps - 1] * rng.random(overlaps.size)).astype(np.int64)
+    same_start = np.flatnonzero(rng.random(stoppages) < same_start_fraction)
+    same_start = same_start[same_start > 0]
+    lpm[same_start] = lpm[same_start - 1]
+    order = np.argsort(lpm, kind='stable')
+    lpm, duration = lpm[order], duration[order]
+
+    if planned_downtime is None or len(planned_downtime) == 0:
+        codes = pd.DataFrame({'Major': ['Non Error'], 'Minor0': ['Unknown cause of failure']})
+    else:
+        codes = pd.DataFrame({'Major': planned_downtime.iloc[:, 0].values, 'Minor0': planned_downtime.iloc[:, 1].values})
+    picked = codes.iloc[rng.integers(0, len(codes), stoppages)].reset_index(drop=True)
+    unknown = rng.random(stoppages) < unknown_code_fraction
+    picked.loc[unknown, 'Major'] = 'Non Error'
+    picked.loc[unknown, 'Minor0'] = 'Unknown cause of failure'
+
+    start = pd.Timestamp(start)
+    lpm_datetime = pd.Series(start + pd.to_timedelta(lpm, unit='s'))
+    rst_datetime = pd.Series(start + pd.to_timedelta(lpm + duration, unit='s'))
+    RobotFailure = pd.DataFrame({
+        'Rst DateTime': format_robot_datetime(rst_datetime, with_seconds), 'Machine#': robot_name,
+        'Emp#': rng.choice([405, 448, 607], stoppages), 'Major': picked['Major'], 'Minor0': picked['Minor0'],
+        'Minor1': rng.choice(['No', 'Yes'], stoppages), 'Minor2': 'NULL', 'Minor3': 'NULL', 'Minor4': 'NULL',
+        'Detail': 'NULL', 'Comment': rng.choice(comments, stoppages), 'Part#': 123456, 'Lot#': 'lotno',
+        'LotCount': rng.integers(0, 10000, stoppages), 'LPM DateTime': format_robot_datetime(lpm_datetime, with_seconds)})
+    return RobotFailure.iloc[np.argsort(rst_datetime.values, kind='stable')].reset_index(drop=True)
+
+
+def write_robot_logs(folder, stoppages, hours=None, robot_name='RB17', year=2022, planned_downtime_path=None, **kwargs):
+    '''
+    Writes <robot>_RejectDataLog_<year>.csv and <robot>_RobotFailureLog_<year>.csv to a folder.
+    arguments: folder, number of stoppages, number of hours (default: 3 per stoppage, as in the examples),
+    robot name, year, path of planned_downtime.csv and the arguments of generate_robot_failure.
+    returns: (RejectData path, RobotFailure path).
+    '''
+    hours = 3 * stoppages if hours is None else hours
+    seed = kwargs.pop('seed', 0)
+    with_seconds = kwargs.pop('with_seconds', False)
+    planned_downtime = None if planned_downtime_path is None else pd.read_csv(planned_downtime_path)
+    os.makedirs(folder, exist_ok=True)
+    start = pd.Timestamp(year=year, month=1, day=1)
+    file_path_RejectData = os.path.join(folder, robot_name + '_RejectDataLog_' + str(year) + '.csv')
+    file_path_RobotFailure = os.path.join(folder, robot_name + '_RobotFailureLog_' + str(year) + '.csv')
+    generate_reject_data(start, hours, robot_name, with_seconds, seed).to_csv(file_path_RejectData, index=False)
+    generate_robot_failure(start, hours, stoppages, robot_name, planned_downtime, with_seconds=with_seconds,
+                           seed=seed + 1, **kwargs).to_csv(file_path_RobotFailure, index=False)
+    return file_path_RejectData, file_path_RobotFailure
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic RejectData and RobotFailure logs.')
+    parser.add_argument('--folder', default='synthetic')
+    parser.add_argument('--stoppages', type=int, default=10000)
+    parser.add_argument('--hours', type=int, default=None, help='default: 3 hours per stoppage')
+    parser.add_argument('--robots', default='RB17', help='comma separated robot names')
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--planned-downtime', default=os.path.join(os.path.dirname(__file__), '..', 'planned_downtime.csv'))
+    parser.add_argument('--mean-stop-seconds', type=float, default=600)
+    parser.add_argument('--stop-distribution', choices=['exponential', 'lognormal'], default='exponential')
+    parser.add_argument('--overlap-fraction', type=float, default=0.05)
+    parser.add_argument('--same-start-fraction', type=float, default=0.05)
+    parser.add_argument('--outage-fraction', type=float, default=0.01)
+    parser.add_argument('--max-outage-hours', type=int, default=30)
+    parser.add_argument('--with-seconds', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for i, robot_name in enumerate(args.robots.split(',')):
+        print(write_robot_logs(args.folder, args.stoppages, args.hours, robot_name, args.year, args.planned_downtime,
+                               mean_stop_seconds=args.mean_stop_seconds, stop_distribution=args.stop_distribution,
+                               overlap_fraction=args.overlap_fraction, same_start_fraction=args.same_start_fraction,
+                               outage_fraction=args.outage_fraction, max_outage_hours=args.max_outage_hours,
+                               with_seconds=args.with_seconds, seed=args.seed + 2 * i))
@@ -0,0 +1,42 @@
+# SQLite hourly store (see write_hourly_store and read_hourly_store).
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ETL_robot_data as etl
+
+
+def hourly_table():
+    return pd.DataFrame({
+        'DateTime': pd.to_datetime(['2022-12-01 04:00', '2022-12-01 04:00', '2022-12-01 05:00', '2022-12-01 06:00']),
+        'Part #': pd.Categorical(['0123', '0123', '0456', None]),
+        'Parts Made': pd.array([100, 50, 80, None], dtype='Int32'),
+        'oee': [0.5, 0.25, 0.75, None]})
+
+
+def test_same_table_twice_writes_nothing(tmp_path):
+    store_path = str(tmp_path / 'hourly_store.sqlite')
+    assert etl.write_hourly_store(hourly_table(), 'RB17', store_path) == 4
+    assert etl.write_hourly_store(hourly_table(), 'RB17', store_path) == 0
+    df = etl.read_hourly_store(store_path, 'RB17')
+    # part numbers are text (leading zeros kept) whatever the other values are
+    assert df['Part #'].tolist() == ['0123', '0123', '0456', None]
+    assert df['Parts Made'].tolist()[:3] == [100, 50, 80]
+
+
+def test_only_the_changed_hours_are_compared(tmp_path):
+    store_path = str(tmp_path / 'hourly_store.sqlite')
+    etl.write_hourly_store(hourly_table(), 'RB17', store_path)
+    hourly = hourly_table()
+    hourly.loc[2, 'oee'] = 0.8
+    hourly.loc[3, 'oee'] = 0.1 # not in the changed hours: not written
+    assert etl.write_hourly_store(hourly, 'RB17', store_path, pd.DatetimeIndex(['2022-12-01 05:00'])) == 1
+    # hours left out of the table are not deleted either
+    assert etl.write_hourly_store(hourly.iloc[2:3], 'RB17', store_path, pd.DatetimeIndex(['2022-12-01 05:00'])) == 0
+    df = etl.read_hourly_store(store_path, 'RB17')
+    assert len(df) == 4
+    assert df['oee'].tolist()[2] == 0.8
+    assert pd.isna(df['oee'].tolist()[3])
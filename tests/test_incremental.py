@@ -0,0 +1,144 @@
+# Replays growing robot logs through the incremental mode and compares the output with a full run.
+'''
+The logs are written in steps, cut at increasing times (RejectData rows logged and stoppages reset up to that time),
+and run_incremental is called after each step; the final output must be the same as a full run on the whole logs.
+
+usage: python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+package_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, package_folder)
+sys.path.insert(0, os.path.join(package_folder, 'benchmarks'))
+import ETL_robot_data as etl
+import generate_robot_logs
+
+config_sources = {'planned_downtime': os.path.join(package_folder, 'planned_downtime.csv'),
+                  'reject_weights': os.path.join(package_folder, 'reject_weights.csv'),
+                  # target_rates.csv ships with no rate: one for the part number of the logs, so the OEE is compared
+                  'target_rates': pd.Series([3.5], index=['123456'])}
+
+
+def read_output(output_path):
+    '''
+    returns: hourly output as exported (N/A read as NaN, floats read back exactly).
+    '''
+    return pd.read_csv(output_path, index_col=0, float_precision='round_trip')
+
+
+def replay_steps(file_path_RejectData, file_path_RobotFailure, steps):
+    '''
+    Finds the number of lines of each log written at each step.
+    arguments: paths of the whole logs and number of steps.
+    returns: list of (RejectData lines, RobotFailure lines), header included; the last step has every line.
+    '''
+    reject_times = etl.read_reject_data(file_path_RejectData)['DateTime']
+    reset_times = etl.read_robot_failure(file_path_RobotFailure)['Rst DateTime']
+    cut_times = pd.date_range(reject_times.min(), reject_times.max(), periods=steps + 1)[1:-1]
+    # the robots append in time order: a step has the leading rows logged up to the cut time
+    leading = lambda times, cut_time: int(np.argmax((times > cut_time).to_numpy())) if (times > cut_time).any() \
+                                      else len(times)
+    return [(1 + leading(reject_times, cut_time), 1 + leading(reset_times, cut_time)) for cut_time in cut_times] + \
+           [(len(reject_times) + 1, len(reset_times) + 1)]
+
+
+def run_replay(folder, file_path_RejectData, file_path_RobotFailure, steps, max_new_bytes=None):
+    '''
+    Writes the logs step by step to folder, calling run_incremental after each step.
+    returns: path of the incremental output.
+    '''
+    stoppages_lookup, reject_weights, target_rates = etl.read_config(etl.resolve_sources('RB17', sources=dict(
+        config_sources, RejectData=file_path_RejectData, RobotFailure=file_path_RobotFailure)))
+    logs = {}
+    for metric, file_path in [('RejectData', file_path_RejectData), ('RobotFailure', file_path_RobotFailure)]:
+        with open(file_path, 'rb') as file1:
+            logs[metric] = (os.path.join(folder, os.path.basename(file_path)), file1.read().splitlines(True))
+    output_path = os.path.join(folder, 'incremental_output.csv')
+    for step in replay_steps(file_path_RejectData, file_path_RobotFailure, steps):
+        for (replay_path, lines), line_count in zip(logs.values(), step):
+            with open(replay_path, 'wb') as file1:
+                file1.write(b''.join(lines[:line_count]))
+        while etl.run_incremental(logs['RejectData'][0], logs['RobotFailure'][0], stoppages_lookup, reject_weights,
+                                  target_rates, output_path, os.path.join(folder, 'checkpoint.json'),
+                                  max_new_bytes) is not None:
+            if max_new_bytes is None:
+                break
+    return output_path
+
+
+def assert_same_as_full_run(output_path, file_path_RejectData, file_path_RobotFailure):
+    df, _ = etl.run('RB17', sources=dict(config_sources, RejectData=file_path_RejectData,
+                                         RobotFailure=file_path_RobotFailure))
+    full_output_path = os.path.join(os.path.dirname(output_path), 'full_output.csv')
+    df.to_csv(full_output_path, na_rep='N/A')
+    full, incremental = read_output(full_output_path), read_output(output_path)
+    # every column, the OEE ones included
+    pd.testing.assert_frame_equal(incremental, full, check_exact=False, rtol=1e-9, atol=1e-9)
+
+
+@pytest.fixture
+def synthetic_logs(tmp_path):
+    return generate_robot_logs.write_robot_logs(str(tmp_path / 'logs'), 200, planned_downtime_path=
+                                                config_sources['planned_downtime'], with_seconds=True, seed=3)
+
+
+@pytest.mark.parametrize('steps', [2, 7])
+def test_examples_replay_matches_full_run(tmp_path, monkeypatch, steps):
+    # the examples log many RejectData rows at the same DateTime, all in the hour the run is cut at
+    monkeypatch.chdir(tmp_path)
+    file_paths = [os.path.join(package_folder, 'examples', 'RB17_RejectDataLog_2022.csv'),
+                  os.path.join(package_folder, 'examples', 'RB17_RobotFailureLog_2022.csv')]
+    assert_same_as_full_run(run_replay(str(tmp_path), *file_paths, steps), *file_paths)
+
+
+@pytest.mark.parametrize('steps, max_new_bytes', [(9, None), (3, 5000)])
+def test_synthetic_replay_matches_full_run(tmp_path, monkeypatch, synthetic_logs, steps, max_new_bytes):
+    monkeypatch.chdir(tmp_path)
+    assert_same_as_full_run(run_replay(str(tmp_path), *synthetic_logs, steps, max_new_bytes), *synthetic_logs)
+
+
+def test_robot_failure_log_with_only_its_header(tmp_path, monkeypatch):
+    # e.g. on 1 January, before the first stoppage of the year: RejectData grows, RobotFailure has no rows
+    monkeypatch.chdir(tmp_path)
+    file_path_RejectData = os.path.join(package_folder, 'examples', 'RB17_RejectDataLog_2022.csv')
+    file_path_RobotFailure = str(tmp_path / 'RB17_RobotFailureLog_2022.csv')
+    with open(os.path.join(package_folder, 'examples', 'RB17_RobotFailureLog_2022.csv')) as file1:
+        header = file1.readline()
+    with open(file_path_RobotFailure, 'w') as file1:
+        file1.write(header)
+    assert_same_as_full_run(run_replay(str(tmp_path), file_path_RejectData, file_path_RobotFailure, 4),
+                            file_path_RejectData, file_path_RobotFailure)
+
+
+def test_reject_data_log_with_only_its_header(tmp_path, monkeypatch):
+    # e.g. on 1 January, stoppages are logged before the first RejectData row: nothing to recompute until then
+    monkeypatch.chdir(tmp_path)
+    file_paths = [os.path.join(package_folder, 'examples', 'RB17_RejectDataLog_2022.csv'),
+                  os.path.join(package_folder, 'examples', 'RB17_RobotFailureLog_2022.csv')]
+    replay_paths = [str(tmp_path / os.path.basename(file_path)) for file_path in file_paths]
+    with open(file_paths[0]) as file1:
+        header = file1.readline()
+    with open(replay_paths[0], 'w') as file1:
+        file1.write(header)
+    with open(file_paths[1]) as file1:
+        robot_failure_lines = file1.readlines()
+    with open(replay_paths[1], 'w') as file1:
+        file1.writelines(robot_failure_lines[:len(robot_failure_lines) // 2])
+    df, _ = etl.run('RB17', sources=dict(config_sources, RejectData=replay_paths[0], RobotFailure=replay_paths[1]))
+    assert len(df) == 0
+    stoppages_lookup, reject_weights, target_rates = etl.read_config(etl.resolve_sources('RB17', sources=dict(
+        config_sources, RejectData=replay_paths[0], RobotFailure=replay_paths[1])))
+    output_path, checkpoint_path = str(tmp_path / 'incremental_output.csv'), str(tmp_path / 'checkpoint.json')
+    assert etl.run_incremental(*replay_paths, stoppages_lookup, reject_weights, target_rates, output_path,
+                               checkpoint_path) is None
+    for file_path, replay_path in zip(file_paths, replay_paths):
+        with open(file_path, 'rb') as file1, open(replay_path, 'wb') as file2:
+            file2.write(file1.read())
+    etl.run_incremental(*replay_paths, stoppages_lookup, reject_weights, target_rates, output_path, checkpoint_path)
+    assert_same_as_full_run(output_path, *file_paths)
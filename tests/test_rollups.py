@@ -0,0 +1,25 @@
+# Rollups of the hourly table (see compute_rollup).
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ETL_robot_data as etl
+
+
+def test_hours_with_several_rows_are_counted_once():
+    # 4:00 logged twice (both rows merged with the 6 minutes down of that hour), 5:05 next to 5:06 (not rounded)
+    hourly = pd.DataFrame({
+        'DateTime': pd.to_datetime(['2022-12-01 04:00', '2022-12-01 04:00', '2022-12-01 05:05', '2022-12-01 05:06',
+                                    '2022-12-01 06:00']),
+        'Parts Made': [100, 50, 80, 20, np.nan], 'Total Rejects': [1.0, 2.0, 0.0, 0.0, np.nan],
+        'total_down_minutes': [6.0, 6.0, 0.0, 0.0, 3.0], 'total_planned_minutes': [0.0, 0.0, 0.0, 0.0, 3.0],
+        'total_unplanned_minutes': [6.0, 6.0, 0.0, 0.0, 0.0]})
+    day = etl.compute_rollup(hourly, 'day').iloc[0]
+    assert day['hours'] == 2
+    assert day['parts_made'] == 250
+    assert day['total_down_minutes'] == 9
+    assert day['availability'] == (120 - 9) / (120 - 3)
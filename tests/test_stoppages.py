@@ -0,0 +1,67 @@
+# Classification (see classify_stoppages) and merge of overlapping stoppages (see merge_overlapping_intervals and
+# drop_repeated_stoppages).
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ETL_robot_data as etl
+
+
+def stoppages(rows):
+    '''
+    returns: classified RobotFailure DataFrame from (LPM DateTime, Rst DateTime, Downtime Type) rows.
+    '''
+    df = pd.DataFrame(rows, columns=['LPM DateTime', 'Rst DateTime', 'Downtime Type'])
+    df['LPM DateTime'] = pd.to_datetime(df['LPM DateTime'])
+    df['Rst DateTime'] = pd.to_datetime(df['Rst DateTime'])
+    return df
+
+
+def test_wildcard_minor_and_unmatched_pairs():
+    lookup = etl.build_stoppage_lookup(pd.DataFrame({
+        'majorStoppageReason': ['Non Error', 'Non Error', 'Error'],
+        'minorStoppageReason': ['Cable', '*', 'Jam'],
+        'classificationStoppageReason': ['planned', 'non-planned', 'non-planned']}))
+    downtime_type, unmatched = etl.classify_stoppages(
+        ['Non Error', 'Non Error', 'Error', 'Error', 'Light', 'Error'],
+        ['Cable', 'Light curtain', 'Jam', 'Unknown', 'Unknown', 'Unknown'], lookup)
+    # an explicit minor wins over the wildcard of its major, which doesn't apply to other majors
+    assert downtime_type.tolist() == ['planned', 'non-planned', 'non-planned', 'no valid code', 'no valid code',
+                                      'no valid code']
+    unmatched = unmatched.sort_values('Major', ignore_index=True)
+    assert unmatched[['Major', 'Minor0']].values.tolist() == [['Error', 'Unknown'], ['Light', 'Unknown']]
+    assert unmatched['count'].tolist() == [2, 1]
+
+
+def test_nested_overlaps_go_to_the_smallest_priority():
+    # 10:15 | 10:40 is inside 10:00 | 11:00, which wins; 10:10 | 10:20 wins over both; the inverted one covers nothing
+    starts = pd.to_datetime(['2022-12-01 10:00', '2022-12-01 10:10', '2022-12-01 10:15', '2022-12-01 10:30'])
+    ends = pd.to_datetime(['2022-12-01 11:00', '2022-12-01 10:20', '2022-12-01 10:40', '2022-12-01 10:00'])
+    owner, piece_starts, piece_ends = etl.merge_overlapping_intervals(starts, ends, [1, 0, 2, 0])
+    assert owner.tolist() == [0, 1, 0]
+    assert piece_starts.tolist() == pd.to_datetime(['2022-12-01 10:00', '2022-12-01 10:10',
+                                                    '2022-12-01 10:20']).values.tolist()
+    assert piece_ends.tolist() == pd.to_datetime(['2022-12-01 10:10', '2022-12-01 10:20',
+                                                  '2022-12-01 11:00']).values.tolist()
+
+
+def test_same_start_continues_from_the_first_reset():
+    # the reason was changed: a new row with the same start and a later reset
+    df = etl.drop_repeated_stoppages(stoppages([('2022-12-01 10:00', '2022-12-01 10:05', 'non-planned'),
+                                                ('2022-12-01 10:00', '2022-12-01 10:30', 'planned')]), [])
+    assert df['Downtime Type'].tolist() == ['non-planned', 'planned']
+    assert df['LPM DateTime'].tolist() == pd.to_datetime(['2022-12-01 10:00', '2022-12-01 10:05']).tolist()
+    assert df['Rst DateTime'].tolist() == pd.to_datetime(['2022-12-01 10:05', '2022-12-01 10:30']).tolist()
+
+
+def test_precedence_wins_over_the_first_reset():
+    df = etl.drop_repeated_stoppages(stoppages([('2022-12-01 10:00', '2022-12-01 10:05', 'non-planned'),
+                                                ('2022-12-01 10:00', '2022-12-01 10:30', 'planned'),
+                                                ('2022-12-01 10:20', '2022-12-01 10:50', 'no valid code')]),
+                                     ['planned', 'non-planned'])
+    assert df['Downtime Type'].tolist() == ['planned', 'no valid code']
+    assert df['LPM DateTime'].tolist() == pd.to_datetime(['2022-12-01 10:00', '2022-12-01 10:30']).tolist()
+    assert df['Rst DateTime'].tolist() == pd.to_datetime(['2022-12-01 10:30', '2022-12-01 10:50']).tolist()